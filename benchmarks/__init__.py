@@ -0,0 +1,6 @@
+"""
+Benchmarks for check-flac
+
+Generates a synthetic library of albums and times each phase of the checks
+against it. Run with `python -m benchmarks --help`.
+"""
@@ -0,0 +1,206 @@
+"""
+Time each phase of the checks against a synthetic library
+
+Phases:
+ - discovery: finding the albums in the library
+ - tag_loading: building the albums (reading the tags of every track)
+ - tag_validation: validating everything except the integrity of the files
+ - integrity_quick: the --quick-verify frame CRC checks
+ - integrity_flac: the `flac --test` checks (only if flac is installed)
+ - integrity_replaygain: the --verify-replaygain decoding and analysis (only if
+   flac and numpy are installed)
+ - integrity_builtin: the same checks as integrity_flac with the built-in decoder
+   used when flac isn't installed (only if numpy is installed)
+
+Use --encoding fixed for audio that's compressed like real FLAC files (the
+default VERBATIM subframes don't need much decoding).
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import checkflac
+from benchmarks import flacgen
+
+
+MIN_DIFFERENCE = 0.01
+
+
+def library_size(root):
+    tracks = size = 0
+    for dirpath, _, files in checkflac.walk_dirs(root):
+        for f in checkflac.files_by_ext(files, "flac"):
+            tracks += 1
+            size += os.path.getsize(os.path.join(dirpath, f))
+    return tracks, size
+
+
+def timed(func, repeat):
+    """Run a function multiple times
+
+    returns (the best time, the result of the last run)
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def run_benchmarks(root, repeat):
+    """Time each phase of the checks
+
+    returns {phase: seconds}
+    """
+    config, _ = checkflac.parse_args(["--no-cache", "--jobs", "1", "--library", root])
+    results = {}
+
+    results["discovery"], directories = timed(lambda: list(checkflac.find_albums(root)), repeat)
+
+    def load():
+        albums = [checkflac.Album(x, config) for x in directories]
+        for album in albums:
+            album.tag_index
+        return albums
+    results["tag_loading"], albums = timed(load, repeat)
+
+    def validate_tags():
+        for album in albums:
+            album._config.no_flactest = True
+            album._config.checked_tags = set()
+            with contextlib.redirect_stdout(io.StringIO()):
+                album.validate()
+            album._config.no_flactest = False
+    results["tag_validation"], _ = timed(validate_tags, repeat)
+
+    discs = [d for a in albums for d in a.discs]
+
+    def check_integrity(quick=False, replaygain=False):
+        for disc in discs:
+            disc.album._config.quick_verify = quick
+            disc.album._config.decode = disc.album._config.verify_replaygain = replaygain
+            disc.check_integrity(disc.tracks)
+    results["integrity_quick"], _ = timed(lambda: check_integrity(quick=True), repeat)
+    if checkflac.EXTERNALS["flac"]:
+        results["integrity_flac"], _ = timed(check_integrity, repeat)
+        if checkflac.np is not None:
+            results["integrity_replaygain"], _ = timed(lambda: check_integrity(replaygain=True), repeat)
+    if checkflac.np is not None:
+        def check_builtin():
+            flac, checkflac.EXTERNALS["flac"] = checkflac.EXTERNALS["flac"], False
+            try:
+                check_integrity()
+            finally:
+                checkflac.EXTERNALS["flac"] = flac
+        results["integrity_builtin"], _ = timed(check_builtin, repeat)
+
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Print how the results compare to a baseline
+
+    returns if any phase was slower than the baseline by more than the threshold
+    (ignoring differences that are too small to measure reliably)
+    """
+    if baseline.get("params") != results["params"]:
+        print("WARNING: the baseline was generated with different parameters")
+
+    regressed = False
+    print()
+    print("{:<20} {:>12} {:>12} {:>8}".format("phase", "baseline", "current", "change"))
+    for phase, current in results["phases"].items():
+        old = baseline["phases"].get(phase)
+        if old is None:
+            print("{:<20} {:>12} {:>11.3f}s {:>8}".format(phase, "-", current["seconds"], "-"))
+            continue
+        change = (current["seconds"] - old["seconds"]) / old["seconds"]
+        flag = ""
+        if change > threshold and current["seconds"] - old["seconds"] > MIN_DIFFERENCE:
+            flag = " (regression)"
+            regressed = True
+        print("{:<20} {:>11.3f}s {:>11.3f}s {:>+7.1f}%{}".format(
+            phase, old["seconds"], current["seconds"], 100 * change, flag))
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m benchmarks", description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dir", action="store", help="Where to generate the library (default: a temporary directory that's deleted afterwards). An existing library will be reused.")
+    parser.add_argument("--albums", action="store", type=int, default=5, help="The number of albums to generate (default: %(default)s)")
+    parser.add_argument("--discs", action="store", type=int, default=1, help="The number of discs per album (default: %(default)s)")
+    parser.add_argument("--tracks", action="store", type=int, default=10, help="The number of tracks per disc (default: %(default)s)")
+    parser.add_argument("--duration", action="store", type=float, default=30, help="The duration of each track in seconds (default: %(default)s)")
+    parser.add_argument("--sample-rate", action="store", type=int, default=44100, help="(default: %(default)s)")
+    parser.add_argument("--channels", action="store", type=int, default=2, help="(default: %(default)s)")
+    parser.add_argument("--bps", action="store", type=int, choices=sorted(flacgen.SAMPLE_SIZE_CODES), default=16, help="Bits per sample (default: %(default)s)")
+    parser.add_argument("--encoding", action="store", choices=flacgen.ENCODINGS, default="verbatim", help="How the audio is encoded (default: %(default)s)")
+    parser.add_argument("--picture-ratio", action="store", type=float, default=0.1, help="The fraction of tracks with embedded pictures (default: %(default)s)")
+    parser.add_argument("--corrupt-ratio", action="store", type=float, default=0.1, help="The fraction of tracks that are corrupted (default: %(default)s)")
+    parser.add_argument("--seed", action="store", type=int, default=0, help="(default: %(default)s)")
+    parser.add_argument("--repeat", action="store", type=int, default=3, help="Use the best time out of this many runs (default: %(default)s)")
+    parser.add_argument("--baseline", action="store", metavar="FILE", help="Compare the results to a stored baseline")
+    parser.add_argument("--threshold", action="store", type=float, default=0.1, help="How much slower than the baseline is a regression (default: %(default)s)")
+    parser.add_argument("--save", action="store", metavar="FILE", help="Store the results as a baseline")
+    args = parser.parse_args()
+
+    params = {k: getattr(args, k) for k in ("albums", "discs", "tracks", "duration", "sample_rate",
+                                            "channels", "bps", "encoding", "picture_ratio", "corrupt_ratio", "seed")}
+    root = args.dir or tempfile.mkdtemp(prefix="checkflac-bench-")
+    try:
+        if not any(checkflac.find_albums(root)):
+            print("Generating library in '{}'".format(root))
+            for n in range(args.albums):
+                flacgen.write_album(
+                    root, n, discs=args.discs, tracks=args.tracks, duration=args.duration,
+                    sample_rate=args.sample_rate, channels=args.channels, bps=args.bps,
+                    encoding=args.encoding, picture_ratio=args.picture_ratio,
+                    corrupt_ratio=args.corrupt_ratio, seed=args.seed
+                )
+
+        tracks, size = library_size(root)
+        print("Library: {} tracks, {:.1f}MB".format(tracks, size / 1e6))
+        phases = run_benchmarks(root, args.repeat)
+    finally:
+        if args.dir is None:
+            shutil.rmtree(root, ignore_errors=True)
+
+    results = {"params": params, "phases": {}}
+    print("{:<20} {:>12} {:>12} {:>10}".format("phase", "time", "tracks/s", "MB/s"))
+    for phase, seconds in phases.items():
+        results["phases"][phase] = {
+            "seconds": seconds,
+            "tracks_per_s": tracks / seconds,
+            "mb_per_s": size / 1e6 / seconds,
+        }
+        print("{:<20} {:>11.3f}s {:>12.1f} {:>10.1f}".format(phase, seconds, tracks / seconds,
+                                                           size / 1e6 / seconds))
+
+    if "integrity_flac" in phases and "integrity_builtin" in phases:
+        print("The built-in decoder is {:.1f}x slower than flac --test".format(
+            phases["integrity_builtin"] / phases["integrity_flac"]))
+
+    regressed = False
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressed = compare(results, json.load(f), args.threshold)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    return 1 if regressed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
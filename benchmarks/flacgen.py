@@ -0,0 +1,331 @@
+"""
+Minimal FLAC writer for generating synthetic albums
+
+By default frames only use CONSTANT (for silence) and VERBATIM subframes of
+noise so no real encoding is needed. The "fixed" encoding (requires numpy)
+writes a noisy tone as FIXED subframes with Rice coded residuals instead, like
+real encoders do. The files are valid FLAC (correct CRCs and STREAMINFO MD5)
+unless they're deliberately corrupted.
+"""
+
+import hashlib
+import os
+import random
+import struct
+
+import checkflac
+from checkflac import np
+
+
+BLOCKSIZE = 4096
+SAMPLE_RATE_CODES = {88200: 1, 176400: 2, 192000: 3, 8000: 4, 16000: 5,
+                     22050: 6, 24000: 7, 32000: 8, 44100: 9, 48000: 10, 96000: 11}
+SAMPLE_SIZE_CODES = {8: 1, 16: 4, 24: 6}
+CORRUPTIONS = ("bitflip", "truncate", "nomd5")
+ENCODINGS = ("verbatim", "fixed")
+FIXED_ORDER = 2
+RICE_PARTITION_ORDER = 4
+
+
+def _crc_table(poly, width):
+    """Generate the lookup table for a (non-reflected) CRC
+
+    The CRCs are calculated here instead of with checkflac so the files can be
+    used to test it.
+    """
+    table = []
+    for i in range(256):
+        crc = i << (width - 8)
+        for _ in range(8):
+            crc <<= 1
+            if crc >> width:
+                crc ^= poly | (1 << width)
+        table.append(crc)
+    return table
+
+
+CRC8_TABLE = _crc_table(0x07, 8)
+CRC16_TABLE = _crc_table(0x8005, 16)
+
+
+def crc8(data):
+    crc = 0
+    for b in data:
+        crc = CRC8_TABLE[crc ^ b]
+    return crc
+
+
+def crc16_frames(data, offsets, lengths):
+    """Get the CRC-16 of each region of the data
+
+    With numpy all the regions are calculated at once (a byte of each at a time)
+    """
+    if np is None:
+        crcs = []
+        for offset, length in zip(offsets, lengths):
+            crc = 0
+            for b in data[offset:offset + length]:
+                crc = ((crc << 8) & 0xFFFF) ^ CRC16_TABLE[(crc >> 8) ^ b]
+            crcs.append(crc)
+        return crcs
+
+    data = np.frombuffer(bytes(data), dtype=np.uint8)
+    table = np.array(CRC16_TABLE, dtype=np.uint16)
+    # Longest first so the regions that aren't done yet are always a prefix
+    order = np.argsort(-np.asarray(lengths), kind="stable")
+    offsets = np.asarray(offsets)[order]
+    lengths = np.asarray(lengths)[order]
+    crc = np.zeros(len(order), dtype=np.uint16)
+    for i in range(int(lengths.max(initial=0))):
+        n = int(np.count_nonzero(lengths > i))
+        crc[:n] = (crc[:n] << 8) ^ table[(crc[:n] >> 8) ^ data[offsets[:n] + i]]
+    ret = [0] * len(order)
+    for i, x in zip(order, crc):
+        ret[i] = int(x)
+    return ret
+
+
+def _utf8_number(n):
+    """Encode a frame number like the FLAC spec's extended UTF-8"""
+    if n < 0x80:
+        return bytes([n])
+    for extra in range(1, 7):
+        if n < 1 << (6 + 5 * extra):
+            break
+    out = []
+    for _ in range(extra):
+        out.append(0x80 | (n & 0x3F))
+        n >>= 6
+    prefix = (0xFF << (7 - extra)) & 0xFF
+    return bytes([prefix | n] + out[::-1])
+
+
+def _pack_bits(values, widths):
+    """Pack unsigned fields of the given widths (most significant bit first)
+
+    returns the bits as an array of 0/1
+    """
+    values = np.asarray(values, dtype=np.uint64)
+    widths = np.asarray(widths, dtype=np.int64)
+    ends = np.cumsum(widths)
+    field = np.repeat(np.arange(len(widths)), widths)
+    shifts = (ends[field] - 1 - np.arange(len(field))).astype(np.uint64)
+    return ((values[field] >> shifts) & np.uint64(1)).astype(np.uint8)
+
+
+def _fixed_subframe(samples, bps):
+    """Encode samples as a FIXED subframe with Rice coded residuals
+
+    returns the bits as an array of 0/1
+    """
+    residual = np.diff(samples, n=FIXED_ORDER)
+    zigzag = np.where(residual < 0, -2 * residual - 1, 2 * residual).astype(np.uint64)
+    partitions = RICE_PARTITION_ORDER if len(samples) % (1 << RICE_PARTITION_ORDER) == 0 else 0
+    bounds = np.arange(1, 1 << partitions) * (len(samples) >> partitions) - FIXED_ORDER
+
+    # Use the Rice parameter that takes the fewest bits in each partition
+    params = []
+    for part in np.split(zigzag, bounds):
+        k = np.arange(31, dtype=np.uint64)
+        params.append(int(np.argmin((part[:, None] >> k).sum(axis=0) + len(part) * (k + np.uint64(1)))))
+    method = 1 if max(params) > 14 else 0
+
+    mask = (1 << bps) - 1
+    values = [(FIXED_ORDER + 8) << 1] + [int(x) & mask for x in samples[:FIXED_ORDER]] + [method, partitions]
+    widths = [8] + [bps] * FIXED_ORDER + [2, 4]
+    fields = [_pack_bits(values, widths)]
+    for part, k in zip(np.split(zigzag, bounds), params):
+        fields.append(_pack_bits([k], [4 + method]))
+        # A Rice code is q zeros, a one, and then k bits: the same as writing
+        # (1 << k) + the remainder in q + 1 + k bits
+        k = np.uint64(k)
+        fields.append(_pack_bits((np.uint64(1) << k) | (part & ((np.uint64(1) << k) - np.uint64(1))),
+                                 (part >> k).astype(np.int64) + int(k) + 1))
+    return np.concatenate(fields)
+
+
+def _metadata_block(block_type, data, last):
+    return bytes([block_type | (0x80 if last else 0)]) + len(data).to_bytes(3, "big") + data
+
+
+def vorbis_comment(tags, vendor="checkflac benchmark"):
+    """Build the data of a VORBIS_COMMENT block from a dict of tag -> [values]"""
+    vendor = vendor.encode("utf-8")
+    comments = ["{}={}".format(k, v).encode("utf-8") for k, vs in tags.items() for v in vs]
+    out = struct.pack("<I", len(vendor)) + vendor + struct.pack("<I", len(comments))
+    for c in comments:
+        out += struct.pack("<I", len(c)) + c
+    return out
+
+
+def picture(rng, size=1024):
+    """Build the data of a PICTURE block (a front cover of random bytes)"""
+    mime = b"image/jpeg"
+    data = rng.getrandbits(size * 8).to_bytes(size, "big")
+    return (struct.pack(">II", 3, len(mime)) + mime + struct.pack(">I", 0) +
+            struct.pack(">IIIII", 500, 500, 24, 0, len(data)) + data)
+
+
+class _Frames(object):
+    """Generates the audio frames and the MD5 of the decoded audio"""
+
+    def __init__(self, sample_rate, channels, bps, rng, encoding="verbatim"):
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.bps = bps
+        self.width = bps // 8
+        self.rng = rng
+        self.encoding = encoding
+        self.md5 = hashlib.md5()
+        self.min_framesize = None
+        self.max_framesize = 0
+
+    def frame(self, number, blocksize, silent):
+        if blocksize == BLOCKSIZE:
+            bs_code, bs_extra = 12, b""
+        else:
+            bs_code, bs_extra = 7, (blocksize - 1).to_bytes(2, "big")
+        sr_code = SAMPLE_RATE_CODES.get(self.sample_rate, 0)
+
+        header = bytes([0xFF, 0xF8, (bs_code << 4) | sr_code,
+                        ((self.channels - 1) << 4) | (SAMPLE_SIZE_CODES[self.bps] << 1)])
+        header += _utf8_number(number) + bs_extra
+        header += bytes([crc8(header)])
+
+        frame = bytearray(header)
+        size = blocksize * self.width
+        if silent:
+            for _ in range(self.channels):
+                frame += b"\x00" + bytes(self.width)  # CONSTANT subframe of 0
+            self.md5.update(bytes(size * self.channels))
+        elif self.encoding == "fixed" and blocksize > FIXED_ORDER:
+            # A tone in each channel with a bit of noise
+            gen = np.random.default_rng(self.rng.getrandbits(32))
+            t = np.arange(blocksize) / self.sample_rate
+            peak = (1 << (self.bps - 1)) - 1
+            samples = []
+            for _ in range(self.channels):
+                tone = np.sin(2 * np.pi * gen.uniform(100, 1000) * t + gen.uniform(0, 2 * np.pi))
+                noise = gen.normal(0, 1 << max(self.bps - 8, 0), blocksize)
+                samples.append(np.clip(np.round(tone * peak * 0.5 + noise), -peak - 1, peak).astype(np.int64))
+            frame += np.packbits(np.concatenate([_fixed_subframe(x, self.bps) for x in samples])).tobytes()
+            interleaved = np.stack(samples, axis=1).astype("<i4").view(np.uint8).reshape(-1, 4)
+            self.md5.update(interleaved[:, :self.width].tobytes())
+        else:
+            interleaved = bytearray(size * self.channels)
+            step = self.width * self.channels
+            for c in range(self.channels):
+                data = self.rng.getrandbits(size * 8).to_bytes(size, "big")
+                frame += b"\x02" + data  # VERBATIM subframe (big-endian)
+                for k in range(self.width):
+                    # MD5 is of the interleaved, little-endian samples
+                    interleaved[c * self.width + k::step] = data[self.width - 1 - k::self.width]
+            self.md5.update(interleaved)
+
+        # Leave space for the CRC-16 (they're all calculated at once later)
+        frame += b"\x00\x00"
+        self.min_framesize = min(self.min_framesize or len(frame), len(frame))
+        self.max_framesize = max(self.max_framesize, len(frame))
+        return frame
+
+
+def write_flac(path, duration, tags, sample_rate=44100, channels=2, bps=16,
+               silence=0.25, embed_picture=False, padding=4096, corruption=None,
+               encoding="verbatim", seed=0):
+    """Write a synthetic FLAC file
+
+    silence is the fraction of the frames that are CONSTANT subframes of 0,
+    corruption is one of CORRUPTIONS (or None), encoding is one of ENCODINGS
+    """
+    if bps not in SAMPLE_SIZE_CODES:
+        raise ValueError("Unsupported bits per sample: {}".format(bps))
+    if encoding not in ENCODINGS:
+        raise ValueError("Unknown encoding: {}".format(encoding))
+    if encoding == "fixed" and np is None:
+        raise ValueError("The fixed encoding requires numpy")
+
+    rng = random.Random(seed)
+    frames = _Frames(sample_rate, channels, bps, rng, encoding)
+    total = int(duration * sample_rate)
+
+    audio = bytearray()
+    offsets = []
+    for number, start in enumerate(range(0, total, BLOCKSIZE)):
+        blocksize = min(BLOCKSIZE, total - start)
+        offsets.append(len(audio))
+        audio += frames.frame(number, blocksize, rng.random() < silence)
+
+    lengths = [b - a - 2 for a, b in zip(offsets, offsets[1:] + [len(audio)])]
+    for offset, length, crc in zip(offsets, lengths, crc16_frames(audio, offsets, lengths)):
+        audio[offset + length:offset + length + 2] = crc.to_bytes(2, "big")
+
+    md5 = frames.md5.digest()
+    if corruption == "nomd5":
+        md5 = bytes(16)
+    elif corruption == "bitflip":
+        audio[len(audio) // 2] ^= 0x10
+    elif corruption == "truncate":
+        del audio[len(audio) * 2 // 3:]
+    elif corruption is not None:
+        raise ValueError("Unknown corruption: {}".format(corruption))
+
+    streaminfo = struct.pack(">HH", BLOCKSIZE, BLOCKSIZE)
+    streaminfo += (frames.min_framesize or 0).to_bytes(3, "big")
+    streaminfo += frames.max_framesize.to_bytes(3, "big")
+    streaminfo += ((sample_rate << 44) | ((channels - 1) << 41) |
+                   ((bps - 1) << 36) | total).to_bytes(8, "big")
+    streaminfo += md5
+
+    blocks = [(checkflac.MetadataBlock.STREAMINFO, streaminfo),
+              (checkflac.MetadataBlock.VORBIS_COMMENT, vorbis_comment(tags))]
+    if embed_picture:
+        blocks.append((checkflac.MetadataBlock.PICTURE, picture(rng)))
+    if padding:
+        blocks.append((checkflac.MetadataBlock.PADDING, bytes(padding)))
+
+    with open(path, "wb") as f:
+        f.write(b"fLaC")
+        for i, (block_type, data) in enumerate(blocks):
+            f.write(_metadata_block(block_type, data, i == len(blocks) - 1))
+        f.write(audio)
+
+
+def write_album(root, number, discs=1, tracks=10, duration=30.0, picture_ratio=0.0,
+                corrupt_ratio=0.0, seed=0, **kwargs):
+    """Write a synthetic album that follows the naming conventions
+
+    returns the path to the album directory
+    """
+    rng = random.Random("{}-{}".format(seed, number))
+    artist = "Artist {}".format(number)
+    title = "Album {}".format(number)
+    directory = os.path.join(root, "{} - {} (2000) [CD-FLAC] {{Synthetic}}".format(artist, title))
+
+    for disc in range(1, discs + 1):
+        disc_dir = os.path.join(directory, "CD{}".format(disc)) if discs > 1 else directory
+        os.makedirs(disc_dir, exist_ok=True)
+        for name in ("cover.jpg", "rip.cue", "rip.log"):
+            open(os.path.join(disc_dir, name), "wb").close()
+
+        for track in range(1, tracks + 1):
+            tags = {
+                "ALBUM": [title], "ALBUMARTIST": [artist], "ARTIST": [artist],
+                "DATE": ["2000"], "ORIGINALDATE": ["2000"], "MEDIA": ["CD"],
+                "DISCNUMBER": [str(disc)], "DISCTOTAL": [str(discs)],
+                "TRACKNUMBER": ["{:02d}".format(track)], "TRACKTOTAL": [str(tracks)],
+                "TITLE": ["Track {}".format(track)], "LABEL": ["Label"],
+                "CATALOGNUMBER": ["CAT-{}".format(number)],
+                "REPLAYGAIN_REFERENCE_LOUDNESS": ["89.0 dB"],
+                "REPLAYGAIN_ALBUM_GAIN": ["-1.00 dB"], "REPLAYGAIN_ALBUM_PEAK": ["1.000000"],
+                "REPLAYGAIN_TRACK_GAIN": ["-1.00 dB"], "REPLAYGAIN_TRACK_PEAK": ["1.000000"],
+            }
+            corruption = None
+            if rng.random() < corrupt_ratio:
+                corruption = rng.choice(CORRUPTIONS)
+            write_flac(
+                os.path.join(disc_dir, "{:02d} - Track {}.flac".format(track, track)),
+                duration, tags, embed_picture=rng.random() < picture_ratio,
+                corruption=corruption, seed=rng.getrandbits(32), **kwargs
+            )
+
+    return directory
@@ -8,14 +8,29 @@ is done at the disc level. This means that the property has to be there,
 but it also has to be the same for every track on that disc. Properties
 at the album level have to be the same for every track in the album.
 
+With --watch it keeps running and rechecks albums as they're added or changed
+(once they've been left alone for a few seconds). With --serve it keeps running
+and checks the albums sent to it by --connect to avoid the start up time.
+
+Each problem found is reported as a finding (the check, item, tag, severity
+and message) and printed as text, or as JSON lines with --format jsonl. To
+use it from Python instead, check_album/check_albums return the findings.
+The tag problems with an obvious fix can be fixed with --fix (see --dry-run).
+
 Checks:
  - The FLAC files:
    - checks that files aren't corrupted by verifying the STREAMINFO MD5
+   - warns if the STREAMINFO doesn't have an MD5 set
+   - can quickly check the frame CRCs and sample count instead (no decoding)
+   - can decode each file once to also check the REPLAYGAIN_TRACK_PEAK and
+     find tracks with identical audio
    - checks the path length of each file
 
  - The extra info:
    - checks if a cue and log file are provided at the disc level (for CD source only)
+   - can check the audio against the CRC32/AccurateRip checksums in the log
    - checks a cover image is provided at the album level
+   - finds tracks and albums with the same audio across a --library
    - checks if an m3u file shoudl be deleted
    - [TODO] check a folder with additional art is provided at the album level
 
@@ -36,6 +51,8 @@ Checks:
    - checks that tracktotal is equal to the number of tracks
    - checks for duplicate tags
    - checks the COMPILATION tag at the album level
+   - finds ALBUMARTIST/ARTIST/LABEL names that are spelled differently in the
+     other albums that were checked (like "The Beatles" and "Beatles, The")
    - Warns if album art is embedded
    - Warns on sort tags (ALBUMSORT, TITLESORT, ARTISTSORT, etc)
    - Validate DATE/ORIGINALDATE are dates
@@ -45,20 +62,75 @@ Checks:
  - replaygain information:
    - checks reference loudness, album gain, album peak are at the disc level
    - checks track gain and track peak are at the track level
+   - can recalculate the gains and peaks from the audio to check the values
 """
 
 import argparse
+import array
+import base64
+import collections
+import concurrent.futures
 import contextlib
+import ctypes
+import ctypes.util
 import enum
 import datetime
+import difflib
 import functools
+import hashlib
+import importlib
+import importlib.util
+import io
+import itertools
+import json
+import math
+import mmap
 import os
 import re
+import select
 import shutil
+import socket
+import socketserver
+import sqlite3
+import stat
+import struct
 import subprocess
 import sys
+import tempfile
+import threading
+import time
+import types
+import unicodedata
+import zlib
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows
+    fcntl = None
+
+
+class LazyModule(types.ModuleType):
+    """A module that's only imported when one of its attributes is first used
+
+    Keeps the startup of the --connect client fast.
+    """
+
+    def __getattr__(self, name):
+        module = importlib.import_module(self.__name__)
+        self.__dict__.update(module.__dict__)
+        return getattr(module, name)
+
+
+class Externals(dict):
+    """If each external program is installed (only looked for when first needed)"""
 
-import taglib
+    def __missing__(self, name):
+        self[name] = bool(shutil.which(name))
+        return self[name]
+
+
+np = LazyModule("numpy") if importlib.util.find_spec("numpy") is not None else None
 
 try:
     # Python < 3.7
@@ -70,6 +142,15 @@ except AttributeError:
 
 MAX_PATH_LENGTH = 180
 COVER_REGEX = re.compile("cover\.(jpe?g|png|gif)")
+REPLAYGAIN_GAIN_REGEX = re.compile("^([+-]?[0-9]+(?:\.[0-9]+)?) dB$")
+LOG_TRACK_REGEX = re.compile("^Track\\s+([0-9]+)\\s*$")
+LOG_CRC32_REGEX = re.compile("^\\s*(?:Copy CRC|CRC32 hash)\\s*:?\\s+([0-9A-F]{8})\\s*$", re.IGNORECASE)
+LOG_EAC_AR_REGEX = re.compile("^\\s*(?:Track\\s+([0-9]+)\\s+)?(?:accurately ripped|cannot be verified as accurate)"
+                              ".*?\\[([0-9A-F]{8})\\].*?(?:\\(AR v([12])\\))?\\s*$", re.IGNORECASE)
+LOG_XLD_AR_REGEX = re.compile("^\\s*AccurateRip v([12]) signature\\s*:\\s*([0-9A-F]{8})\\s*$", re.IGNORECASE)
+CUE_TRACK_REGEX = re.compile("^\\s*TRACK\\s+([0-9]+)\\s+AUDIO\\s*$", re.IGNORECASE)
+VORBIS_NAME_REGEX = re.compile("[\x20-\x3C\x3E-\x7D]+")
+DISC_FOLDER_REGEX = re.compile("(?:CD|Disc) ?[0-9]+", re.IGNORECASE)
 DATE_TAGS = set(["DATE", "ORIGINALDATE"])
 TAG_MAP = {  # Common bad tags, substitutions, and misspellings
     re.compile("(ORIGINAL)?YEAR"): "\\1DATE",
@@ -79,11 +160,33 @@ TAG_MAP = {  # Common bad tags, substitutions, and misspellings
 }
 VARIOUS_ARTISTS = set(["various artists", "various", "va"])
 TAG_TRANSLATION = str.maketrans('<>:\/|"', "[]----'", "?*")
-EXTERNALS = {x: bool(shutil.which(x)) for x in ("flac", "metaflac")}
+SPELLING_TAGS = {"ALBUMARTIST": "artist", "ARTIST": "artist", "LABEL": "label"}
+ARTICLE_REGEX = re.compile(r"^(?:the|a|an) (.+)$|^(.+), ?(?:the|a|an)$")
+FS_IOC_FIEMAP = 0xC020660B
+IN_NONBLOCK, IN_CLOEXEC = 0o4000, 0o2000000
+IN_ATTRIB, IN_CLOSE_WRITE, IN_MOVED_FROM, IN_MOVED_TO = 0x4, 0x8, 0x40, 0x80
+IN_CREATE, IN_DELETE, IN_Q_OVERFLOW, IN_IGNORED, IN_ISDIR = 0x100, 0x200, 0x4000, 0x8000, 0x40000000
+POLL_INTERVAL = 2
+JOURNAL_SYNC_INTERVAL = 1
+# Options that don't change the findings of an album (for --resume)
+RUN_OPTIONS = {"jobs", "album_jobs", "io_concurrency_per_device", "rebuild_cache", "cache_size",
+               "profile", "profile_trace", "resume", "watch", "settle_time", "serve", "connect"}
+PCM_BUFFER_SIZE = 1 << 20
+PEAK_TOLERANCE = 0.0001
+GAIN_TOLERANCE = 0.1
+FIX_PADDING = 4096  # Left for later changes when a file has to be rewritten
+TAG_FIX_ORDER = ("strip", "delete_blank", "rename", "delete", "set")
+FLAC_TEST_BATCH_SIZE = 32  # Keeps the command line short enough on every platform
+EXTERNAL_PROGRAMS = ("flac",)
+EXTERNALS = Externals()
+CACHE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME") or
+                         os.path.join(os.path.expanduser("~"), ".cache"),
+                         "check-flac")
+CACHE_FILE = os.path.join(CACHE_DIR, "cache.sqlite")
 
 
 def has_ext(path, ext):
-    return path.rsplit(".", 1)[-1].lower() == ext.lower()
+    return os.path.splitext(path)[1][1:].lower() == ext.lower()
 
 
 def files_by_ext(files, ext):
@@ -94,18 +197,318 @@ def files_by_regex(files, regex):
     return [x for x in files if regex.fullmatch(os.path.basename(x))]
 
 
+def walk_dirs(top):
+    """Like os.walk (top-down) but uses os.scandir and yields DirEntry objects
+
+    The file type information from the directory listing is reused instead of
+    calling stat on every entry. Removing entries from the yielded list of
+    directories will stop them from being walked.
+
+    yields (dirpath, [DirEntry of each directory], [name of each file])
+    """
+    try:
+        # Reading every entry closes the iterator (it's only a context manager on 3.6+)
+        entries = sorted(os.scandir(top), key=lambda x: x.name)
+    except OSError:
+        return
+
+    dirs, files = [], []
+    for entry in entries:
+        try:
+            is_dir = entry.is_dir(follow_symlinks=False)
+        except OSError:
+            is_dir = False
+        (dirs if is_dir else files).append(entry if is_dir else entry.name)
+
+    yield top, dirs, files
+    for entry in dirs:
+        yield from walk_dirs(entry.path)
+
+
+def is_album(dirs, files):
+    """Check if a directory listing (like from walk_dirs) is of an album
+
+    Any directory with FLAC files or disc folders in it is an album.
+    """
+    return (any(has_ext(x, "flac") for x in files) or
+            any(DISC_FOLDER_REGEX.fullmatch(x.name) for x in dirs))
+
+
+def find_albums(root):
+    """Find all the album directories under a root directory
+
+    Albums are yielded as they're found and aren't descended into any further.
+    """
+    for dirpath, dirs, files in walk_dirs(root):
+        if is_album(dirs, files):
+            dirs.clear()
+            yield dirpath
+
+
+def find_changed_albums(root, path):
+    """Find the albums under a root directory that a changed path affects
+
+    That's the album it's in, or all the albums under it if it's not in one.
+    """
+    rel = os.path.relpath(path, root)
+    if rel == os.pardir or rel.startswith(os.pardir + os.sep):
+        return []
+
+    directory = root
+    for part in [] if rel == os.curdir else rel.split(os.sep):
+        _, dirs, files = next(walk_dirs(directory), (None, [], []))
+        if is_album(dirs, files):
+            return [directory]
+        directory = os.path.join(directory, part)
+
+    if os.path.isdir(path):
+        return list(find_albums(path))
+    return []
+
+
+class InotifyWatcher(object):
+    """Watches a directory tree for changes using inotify (Linux only)"""
+
+    MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+    def __init__(self, root):
+        self.root = root
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "Failed to initialize inotify")
+        self._watches = {}
+        self._watch_tree(root)
+
+    def _watch_tree(self, top):
+        for dirpath, _, _ in walk_dirs(top):
+            wd = self._libc.inotify_add_watch(self._fd, os.fsencode(dirpath), self.MASK)
+            if wd >= 0:
+                self._watches[wd] = dirpath
+
+    def changes(self, timeout=None):
+        """Wait for changes
+
+        returns the paths that changed (empty if the timeout was reached)
+        """
+        if not select.select([self._fd], [], [], timeout)[0]:
+            return set()
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return set()
+
+        changed = set()
+        pos = 0
+        while pos < len(data):
+            wd, mask, _, length = struct.unpack_from("iIII", data, pos)
+            name = os.fsdecode(data[pos + 16:pos + 16 + length].rstrip(b"\0"))
+            pos += 16 + length
+
+            if mask & IN_Q_OVERFLOW:
+                # Events were lost - assume everything changed
+                changed.add(self.root)
+                continue
+            if mask & IN_IGNORED:
+                self._watches.pop(wd, None)
+                continue
+            if wd not in self._watches:
+                continue
+
+            path = os.path.join(self._watches[wd], name)
+            changed.add(path)
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                self._watch_tree(path)
+        return changed
+
+
+class PollingWatcher(object):
+    """Watches a directory tree for changes by scanning it periodically"""
+
+    def __init__(self, root, interval=POLL_INTERVAL):
+        self.root = root
+        self.interval = interval
+        self._snapshot = self._scan()
+
+    def _scan(self):
+        ret = {}
+        for dirpath, dirs, files in walk_dirs(self.root):
+            for name in itertools.chain((x.name for x in dirs), files):
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                ret[path] = (st.st_size, st.st_mtime_ns)
+        return ret
+
+    def changes(self, timeout=None):
+        """Wait for changes
+
+        returns the paths that changed (empty if the timeout was reached)
+        """
+        time.sleep(self.interval if timeout is None else min(timeout, self.interval))
+        snapshot = self._scan()
+        changed = {x for x in snapshot.keys() | self._snapshot.keys()
+                   if snapshot.get(x) != self._snapshot.get(x)}
+        self._snapshot = snapshot
+        return changed
+
+
+def watch_albums(root, settle_time):
+    """Wait for albums under a directory to change
+
+    An album is only yielded once nothing in it has changed for settle_time
+    seconds so it isn't checked while it's still being written.
+
+    yields lists of the album directories that changed (forever)
+    """
+    root = os.path.abspath(root)
+    try:
+        watcher = InotifyWatcher(root)
+    except (OSError, AttributeError, TypeError):
+        # Not on Linux
+        watcher = PollingWatcher(root)
+
+    pending = {}
+    while True:
+        timeout = None
+        if pending:
+            timeout = max(min(pending.values()) + settle_time - time.monotonic(), 0)
+        for path in watcher.changes(timeout):
+            for album in find_changed_albums(root, path):
+                pending[album] = time.monotonic()
+
+        now = time.monotonic()
+        settled = sorted(x for x, t in pending.items() if now - t >= settle_time)
+        for album in settled:
+            del pending[album]
+        settled = [x for x in settled if os.path.isdir(x)]
+        if settled:
+            yield settled
+
+
+class _Timer(object):
+    __slots__ = ("profiler", "name", "subprocess", "start")
+
+    def __init__(self, profiler, name, subprocess):
+        self.profiler = profiler
+        self.name = name
+        self.subprocess = subprocess
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *_):
+        self.profiler.add(self.name, self.start, time.perf_counter() - self.start,
+                          self.subprocess)
+
+
+class Profiler(object):
+    """Records how long each named stage of the checks takes
+
+    Does nothing unless enabled. Events are (name, start, duration,
+    subprocess, pid, thread id) and can be moved between processes.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.events = []
+        self._lock = threading.Lock()
+
+    def timed(self, name, subprocess=False):
+        """Context manager that records how long its body takes"""
+        if not self.enabled:
+            return contextlib.suppress()
+        return _Timer(self, name, subprocess)
+
+    def profiled(self, func):
+        """Decorator to time a method of a validator (per level)"""
+        @functools.wraps(func)
+        def wrapped(obj, *args, **kwargs):
+            with self.timed("{}.{}".format(obj.level, func.__name__)):
+                return func(obj, *args, **kwargs)
+
+        return wrapped
+
+    def add(self, name, start, duration, subprocess=False):
+        with self._lock:
+            self.events.append((name, start, duration, subprocess, os.getpid(),
+                                threading.get_ident()))
+
+    def extend(self, events):
+        with self._lock:
+            self.events.extend(events)
+
+    def pop_events(self):
+        with self._lock:
+            events, self.events = self.events, []
+        return events
+
+    def print_report(self, wall_time):
+        stats = collections.defaultdict(list)
+        for name, _, duration, _, _, _ in self.events:
+            stats[name].append(duration)
+        in_subprocesses = sum(e[2] for e in self.events if e[3])
+
+        print("Profile: {:.3f}s wall time, {:.3f}s ({:.1f}% of wall time) waiting on "
+              "subprocesses".format(wall_time, in_subprocesses,
+                                     100 * in_subprocesses / wall_time if wall_time else 0))
+        print("{:<40} {:>8} {:>10} {:>10} {:>10}".format("check", "count", "total", "mean", "p95"))
+        for name, durations in sorted(stats.items(), key=lambda x: -sum(x[1])):
+            durations.sort()
+            p95 = durations[max(math.ceil(len(durations) * 0.95) - 1, 0)]
+            total = sum(durations)
+            print("{:<40} {:>8} {:>9.3f}s {:>8.3f}ms {:>8.3f}ms".format(
+                name, len(durations), total, 1000 * total / len(durations), 1000 * p95))
+
+    def write_trace(self, path):
+        """Write the events in the Chrome trace event format"""
+        origin = min((e[1] for e in self.events), default=0)
+        trace = [{
+            "name": name,
+            "cat": "subprocess" if subprocess else "check",
+            "ph": "X",
+            "ts": (start - origin) * 1e6,
+            "dur": duration * 1e6,
+            "pid": pid,
+            "tid": tid,
+        } for name, start, duration, subprocess, pid, tid in self.events]
+        with open(path, "w") as f:
+            json.dump({"traceEvents": trace, "displayTimeUnit": "ms"}, f)
+
+
+PROFILER = Profiler()
+
+
 def validator(func):
     """Calls the pre_validate and post_validate functions before and after the
     wrapped function"""
     @functools.wraps(func)
     def wrapped(self):
         self.pre_validate()
-        func(self)
+        with PROFILER.timed("{}.{}".format(self.level, func.__name__)):
+            func(self)
         self.post_validate()
 
     return wrapped
 
 
+def name_key(name):
+    """Normalise a name so that different spellings of it are the same
+
+    Ignores case, accents, punctuation, whitespace, the characters that are
+    replaced in filenames, and leading or trailing articles (so "The Beatles"
+    and "Beatles, The" are the same)
+    """
+    key = unicodedata.normalize("NFKD", name.translate(TAG_TRANSLATION).casefold().strip())
+    key = "".join(x for x in key if not unicodedata.combining(x))
+    m = ARTICLE_REGEX.match(key)
+    if m:
+        key = m.group(1) or m.group(2)
+    return "".join(re.findall(r"\w+", key.replace("&", "and")))
+
+
 def compare_names(tag, name, tagname=None):
     """Compare a tag against a filename and return if they're the same
 
@@ -160,10 +563,1628 @@ def remove_optional_regex(pattern, name):
                   pattern)
 
 
+@functools.lru_cache(maxsize=None)
+def compile_name_regex(pattern, remove=None):
+    """Compile a name pattern, optionally removing an optional part of it"""
+    if remove is not None:
+        pattern = remove_optional_regex(pattern, remove)
+    return re.compile(pattern)
+
+
+def disk_location(path):
+    """Get where a file is stored so files can be read in the order they are on the disk
+
+    Uses the physical offset of the start of the file if the filesystem
+    supports FIEMAP (Linux), otherwise the inode number.
+
+    returns (device, offset)
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None, 0
+
+    if fcntl is not None:
+        # struct fiemap with space for a single struct fiemap_extent
+        buf = bytearray(struct.pack("=QQIIII", 0, 2 ** 64 - 1, 0, 0, 1, 0) + bytes(56))
+        try:
+            with open(path, "rb") as f:
+                fcntl.ioctl(f.fileno(), FS_IOC_FIEMAP, buf)
+        except OSError:
+            pass
+        else:
+            mapped_extents, = struct.unpack_from("=I", buf, 20)
+            if mapped_extents:
+                physical, = struct.unpack_from("=Q", buf, 40)
+                return st.st_dev, physical
+
+    return st.st_dev, st.st_ino
+
+
+class IOScheduler(object):
+    """Limits how many jobs read from each device at the same time
+
+    Jobs reading from the same device start in the order they were submitted.
+    """
+
+    def __init__(self, limit=None):
+        self.limit = limit
+        self._condition = threading.Condition()
+        self._submitted = collections.Counter()
+        self._started = collections.Counter()
+        self._running = collections.Counter()
+
+    def submit(self, executor, device, func, *args):
+        """Submit a job that reads from a device to an executor"""
+        if self.limit is None:
+            return executor.submit(func, *args)
+
+        with self._condition:
+            ticket = self._submitted[device]
+            self._submitted[device] += 1
+        return executor.submit(self._run, device, ticket, func, *args)
+
+    def _run(self, device, ticket, func, *args):
+        with self._condition:
+            with PROFILER.timed("wait for device"):
+                self._condition.wait_for(lambda: self._started[device] == ticket and
+                                         self._running[device] < self.limit)
+            self._started[device] += 1
+            self._running[device] += 1
+            self._condition.notify_all()
+        try:
+            return func(*args)
+        finally:
+            with self._condition:
+                self._running[device] -= 1
+                self._condition.notify_all()
+
+
 quiet_call = functools.partial(subprocess.call, stdout=subprocess.DEVNULL,
                                stderr=subprocess.DEVNULL)
 
 
+def flac_test(paths, warnings_as_errors=False):
+    """Test FLAC files in the same directory with as few `flac --test` calls as possible
+
+    flac reports "<name>: ok" for every file that passes. Any file it didn't
+    report on at all is tested on its own.
+
+    returns {path: if the file was verified}
+    """
+    cmd = ["flac", "--test"]
+    if warnings_as_errors:
+        cmd.append("--warnings-as-errors")
+
+    ret = {}
+    for i in range(0, len(paths), FLAC_TEST_BATCH_SIZE):
+        batch = {os.path.basename(x): x for x in paths[i:i + FLAC_TEST_BATCH_SIZE]}
+        with PROFILER.timed("flac --test", subprocess=True):
+            proc = subprocess.run(cmd + list(batch.values()), stdout=subprocess.DEVNULL,
+                                  stderr=subprocess.PIPE)
+
+        # The progress is overwritten using carriage returns
+        status = {}
+        for line in re.split("[\r\n]", os.fsdecode(proc.stderr)):
+            for name in batch:
+                if line.startswith(name + ": "):
+                    status[name] = line[len(name) + 2:].strip()
+
+        for name, path in batch.items():
+            if name in status:
+                ret[path] = status[name] == "ok"
+            else:
+                with PROFILER.timed("flac --test", subprocess=True):
+                    ret[path] = quiet_call(cmd + [path]) == 0
+    return ret
+
+
+class MetadataBlock(enum.IntEnum):
+    STREAMINFO = 0
+    PADDING = 1
+    APPLICATION = 2
+    SEEKTABLE = 3
+    VORBIS_COMMENT = 4
+    CUESHEET = 5
+    PICTURE = 6
+
+
+IntegrityResult = collections.namedtuple("IntegrityResult", ("metadata", "verified", "frame_errors", "audio"))
+StreamInfo = collections.namedtuple("StreamInfo", (
+    "min_blocksize", "max_blocksize", "min_framesize", "max_framesize",
+    "sample_rate", "channels", "bits_per_sample", "total_samples", "md5"))
+
+
+class FlacMetadata(object):
+    """The metadata blocks at the start of a FLAC file
+
+    Only the block headers and the STREAMINFO and VORBIS_COMMENT blocks are
+    read, the rest of the data is skipped over.
+
+    The tags are a dict of upper-cased names to lists of values (in the order
+    they're in the file), including any blank values.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.blocks = []  # (type, offset of data, length of data)
+        self.streaminfo = None
+        self.vendor = None
+        self.tags = {}
+
+        with open(path, "rb") as f:
+            self._read(f)
+        self.audio_offset = self.blocks[-1][1] + self.blocks[-1][2]
+
+    def _read(self, f):
+        magic = f.read(10)
+        if magic[:3] == b"ID3":
+            # Skip over an ID3v2 tag (not valid FLAC, but it happens)
+            size = 10 + sum((b & 0x7F) << (7 * i) for i, b in enumerate(reversed(magic[6:10])))
+            if magic[5] & 0x10:
+                size += 10
+            f.seek(size)
+            magic = f.read(4)
+        else:
+            f.seek(4)
+
+        if magic[:4] != b"fLaC":
+            raise ValueError("'{}' is not a FLAC file".format(self.path))
+
+        last = False
+        while not last:
+            header = f.read(4)
+            if len(header) < 4:
+                raise ValueError("'{}' has truncated metadata".format(self.path))
+
+            last = bool(header[0] & 0x80)
+            block_type = header[0] & 0x7F
+            length = int.from_bytes(header[1:], "big")
+            offset = f.tell()
+            self.blocks.append((block_type, offset, length))
+
+            if block_type == MetadataBlock.STREAMINFO:
+                self.streaminfo = self._parse_streaminfo(f.read(length))
+            elif block_type == MetadataBlock.VORBIS_COMMENT and self.vendor is None:
+                self._parse_vorbis_comment(f.read(length))
+            else:
+                f.seek(length, os.SEEK_CUR)
+
+        if self.streaminfo is None or self.blocks[0][0] != MetadataBlock.STREAMINFO:
+            raise ValueError("'{}' doesn't start with a STREAMINFO block".format(self.path))
+
+    def _parse_streaminfo(self, data):
+        if len(data) < 34:
+            raise ValueError("'{}' has a truncated STREAMINFO block".format(self.path))
+
+        # 20 bits sample rate, 3 bits channels-1, 5 bits bps-1, 36 bits samples
+        packed = int.from_bytes(data[10:18], "big")
+        return StreamInfo(
+            min_blocksize=int.from_bytes(data[0:2], "big"),
+            max_blocksize=int.from_bytes(data[2:4], "big"),
+            min_framesize=int.from_bytes(data[4:7], "big"),
+            max_framesize=int.from_bytes(data[7:10], "big"),
+            sample_rate=packed >> 44,
+            channels=((packed >> 41) & 0x07) + 1,
+            bits_per_sample=((packed >> 36) & 0x1F) + 1,
+            total_samples=packed & 0xFFFFFFFFF,
+            md5=bytes(data[18:34]),
+        )
+
+    def _parse_vorbis_comment(self, data):
+        # Unlike the rest of FLAC, the lengths in here are little-endian
+        try:
+            pos = 4 + int.from_bytes(data[0:4], "little")
+            self.vendor = data[4:pos].decode("utf-8", "replace")
+            count = int.from_bytes(data[pos:pos + 4], "little")
+            pos += 4
+            for _ in range(count):
+                length = int.from_bytes(data[pos:pos + 4], "little")
+                comment = data[pos + 4:pos + 4 + length]
+                if len(data) < pos + 4 + length:
+                    raise IndexError
+                pos += 4 + length
+
+                name, sep, value = comment.decode("utf-8", "replace").partition("=")
+                if sep and VORBIS_NAME_REGEX.fullmatch(name):
+                    self.tags.setdefault(name.upper(), []).append(value)
+        except IndexError:
+            raise ValueError("'{}' has a truncated VORBIS_COMMENT block".format(self.path))
+
+    def find(self, block_type):
+        """Get all the (offset, length) pairs of the blocks of a type"""
+        return [(o, l) for t, o, l in self.blocks if t == block_type]
+
+    @property
+    def has_picture(self):
+        return bool(self.find(MetadataBlock.PICTURE))
+
+    @property
+    def has_md5(self):
+        return any(self.streaminfo.md5)
+
+    @property
+    def padding(self):
+        """The total amount of padding in bytes"""
+        return sum(l for _, l in self.find(MetadataBlock.PADDING))
+
+
+def _split_vorbis_comment(data):
+    """Get the (vendor, ["NAME=value" for each comment]) of a VORBIS_COMMENT block
+
+    Invalid UTF-8 is kept as surrogates so it's written back unchanged.
+    """
+    pos = 4 + int.from_bytes(data[0:4], "little")
+    vendor = data[4:pos]
+    count = int.from_bytes(data[pos:pos + 4], "little")
+    pos += 4
+    comments = []
+    for _ in range(count):
+        length = int.from_bytes(data[pos:pos + 4], "little")
+        comments.append(data[pos + 4:pos + 4 + length].decode("utf-8", "surrogateescape"))
+        pos += 4 + length
+    return vendor, comments
+
+
+def _join_vorbis_comment(vendor, comments):
+    data = [len(vendor).to_bytes(4, "little"), vendor, len(comments).to_bytes(4, "little")]
+    for comment in comments:
+        comment = comment.encode("utf-8", "surrogateescape")
+        data.extend((len(comment).to_bytes(4, "little"), comment))
+    return b"".join(data)
+
+
+def fix_comments(comments, fixes):
+    """Apply fixes to a list of "NAME=value" comments
+
+    fixes are (operation, tag, *args) tuples, where the operation is one of:
+     - strip: remove the whitespace around the values (blank values are kept)
+     - delete_blank: remove the blank values
+     - rename: rename the tag to args[0] (or remove it if args[0] already exists)
+     - delete: remove the tag
+     - set: replace the values with args[0]
+
+    The same fixes are applied to every track of an album so each one only
+    changes what's there in the comments it's given.
+
+    returns the new list of comments
+    """
+    for op, tag, *args in sorted(fixes, key=lambda x: (TAG_FIX_ORDER.index(x[0]), x)):
+        names = [x.partition("=")[0].upper() for x in comments]
+        if op == "set":
+            # Keep it where the first value was
+            position = names.index(tag) if tag in names else len(comments)
+            comments = [x for x, name in zip(comments, names) if name != tag]
+            comments.insert(position, "{}={}".format(tag, args[0]))
+            continue
+
+        fixed = []
+        for comment, name in zip(comments, names):
+            value = comment.partition("=")[2]
+            if name != tag or "=" not in comment:
+                fixed.append(comment)
+            elif op == "strip":
+                fixed.append("{}={}".format(comment.partition("=")[0], value.strip() or value))
+            elif op == "delete_blank" and value.strip():
+                fixed.append(comment)
+            elif op == "rename" and args[0] not in names:
+                fixed.append("{}={}".format(args[0], value))
+        comments = fixed
+    return comments
+
+
+def rewrite_tags(path, fixes, dry_run=False):
+    """Apply fixes (see fix_comments) to the VORBIS_COMMENT block of a FLAC file
+
+    If the new block fits in the existing metadata (using the padding) only
+    the metadata is rewritten in place. Otherwise the file is rewritten to a
+    temporary file first with FIX_PADDING bytes of padding for next time.
+
+    returns (the old comments, the new comments)
+    """
+    metadata = FlacMetadata(path)
+    start = metadata.blocks[0][1] - 4
+    with open(path, "rb") as f:
+        f.seek(start)
+        region = f.read(metadata.audio_offset - start)
+    blocks = [(t, region[o - start:o - start + l]) for t, o, l in metadata.blocks]
+
+    index = next((i for i, (t, _) in enumerate(blocks) if t == MetadataBlock.VORBIS_COMMENT), None)
+    if index is None:
+        index = 1
+        blocks.insert(index, (MetadataBlock.VORBIS_COMMENT, _join_vorbis_comment(b"", [])))
+    vendor, old = _split_vorbis_comment(blocks[index][1])
+    new = fix_comments(old, fixes)
+    if new == old or dry_run:
+        return old, new
+
+    blocks[index] = (MetadataBlock.VORBIS_COMMENT, _join_vorbis_comment(vendor, new))
+    blocks = [(t, d) for t, d in blocks if t != MetadataBlock.PADDING]
+    if len(blocks[index][1]) >= 1 << 24:
+        raise ValueError("The tags of '{}' are too big".format(path))
+
+    padding = len(region) - sum(4 + len(d) for _, d in blocks) - 4
+    # Without any padding left there's no PADDING block header either
+    in_place = padding == -4 or 0 <= padding < 1 << 24
+    if not in_place:
+        padding = FIX_PADDING
+    if padding >= 0:
+        blocks.append((MetadataBlock.PADDING, bytes(padding)))
+    data = b"".join(bytes([t | (0x80 if i == len(blocks) - 1 else 0)]) + len(d).to_bytes(3, "big") + d
+                    for i, (t, d) in enumerate(blocks))
+
+    if in_place:
+        with open(path, "r+b") as f:
+            f.seek(start)
+            f.write(data)
+        return old, new
+
+    directory, name = os.path.split(path)
+    with open(path, "rb") as src, tempfile.NamedTemporaryFile(
+            dir=directory, prefix=".{}.".format(name), delete=False) as dst:
+        try:
+            dst.write(src.read(start))
+            dst.write(data)
+            src.seek(metadata.audio_offset)
+            shutil.copyfileobj(src, dst, PCM_BUFFER_SIZE)
+            dst.close()
+            shutil.copymode(path, dst.name)
+            os.replace(dst.name, path)
+        except BaseException:
+            os.unlink(dst.name)
+            raise
+    return old, new
+
+
+def _crc_table(poly, width):
+    """Generate the lookup table for a (non-reflected) CRC"""
+    top = 1 << (width - 1)
+    mask = (1 << width) - 1
+    table = []
+    for i in range(256):
+        crc = i << (width - 8)
+        for _ in range(8):
+            crc = ((crc << 1) ^ poly) if crc & top else (crc << 1)
+        table.append(crc & mask)
+    return table
+
+
+CRC8_TABLE = _crc_table(0x07, 8)
+CRC16_TABLE = _crc_table(0x8005, 16)
+FRAME_SAMPLE_RATES = (None, 88200, 176400, 192000, 8000, 16000, 22050, 24000,
+                      32000, 44100, 48000, 96000)
+FRAME_SAMPLE_SIZES = (None, 8, 12, None, 16, 20, 24, 32)
+DECODE_BATCH_FRAMES = 256  # Frames decoded at once by the built-in decoder (limits the memory use)
+
+
+def crc8(data):
+    crc = 0
+    for b in data:
+        crc = CRC8_TABLE[crc ^ b]
+    return crc
+
+
+def crc16(data):
+    crc = 0
+    for b in data:
+        crc = ((crc << 8) & 0xFFFF) ^ CRC16_TABLE[(crc >> 8) ^ b]
+    return crc
+
+
+@functools.lru_cache(maxsize=None)
+def _crc16_word_tables():
+    """Tables to process 8 bytes of data at a time as four 16-bit words"""
+    table = np.array(CRC16_TABLE, dtype=np.uint32)
+    shift = lambda c, b: ((c << 8) & 0xFFFF) ^ table[(c >> 8) ^ b]
+
+    words = np.arange(1 << 16, dtype=np.uint32)
+    tables = [shift(shift(np.zeros_like(words), words >> 8), words & 0xFF)]
+    for _ in range(3):
+        # Account for the 2 bytes of data that follow it
+        tables.append(shift(shift(tables[-1], 0), 0))
+    return tables
+
+
+def crc16_regions(data, starts, lengths):
+    """Calculate the CRC-16 of many regions of data at once
+
+    Works on all the regions in lockstep so the per-byte work is done by numpy
+    instead of in a Python loop. Leading zeros don't change the CRC so regions
+    can be processed in 8-byte steps after the first few bytes.
+    """
+    if np is None:
+        return [crc16(data[s:s + l]) for s, l in zip(starts, lengths)]
+
+    data = np.frombuffer(data, dtype=np.uint8)
+    starts = np.asarray(starts, dtype=np.int64)
+    lengths = np.asarray(lengths, dtype=np.int64)
+    table = np.array(CRC16_TABLE, dtype=np.uint32)
+    t0, t1, t2, t3 = _crc16_word_tables()
+    crc = np.zeros(len(starts), dtype=np.uint32)
+
+    # Process the bytes that don't fit evenly into 8-byte steps one at a time
+    head = lengths % 8
+    for i in range(7):
+        idx = np.flatnonzero(head > i)
+        if not len(idx):
+            break
+        c = crc[idx]
+        crc[idx] = ((c << 8) & 0xFFFF) ^ table[(c >> 8) ^ data[starts[idx] + i]]
+
+    # Sort so the regions that still need work are always at the front
+    steps = lengths // 8
+    order = np.argsort(-steps, kind="stable")
+    pos = (starts + head)[order]
+    steps = steps[order]
+    result = crc[order]
+    offsets = np.arange(8)
+    for i in range(int(steps[0]) if len(steps) else 0):
+        n = int(np.count_nonzero(steps > i))
+        b = data[pos[:n, None] + (offsets + i * 8)].astype(np.uint32)
+        w = (b[:, 0::2] << 8) | b[:, 1::2]
+        result[:n] = t3[result[:n] ^ w[:, 0]] ^ t2[w[:, 1]] ^ t1[w[:, 2]] ^ t0[w[:, 3]]
+
+    crc[order] = result
+    return crc.tolist()
+
+
+def parse_frame_header(data, pos, streaminfo):
+    """Parse the header of a FLAC frame
+
+    Returns (header length, frame/sample number, block size, variable) or None
+    if there isn't a valid header (that matches the STREAMINFO) at the position
+    """
+    b = data[pos:pos + 16]
+    if len(b) < 6 or b[0] != 0xFF or b[1] & 0xFE != 0xF8 or b[3] & 0x01:
+        return None
+
+    bs_code, sr_code = b[2] >> 4, b[2] & 0x0F
+    channels, ss_code = b[3] >> 4, (b[3] >> 1) & 0x07
+    if bs_code == 0 or sr_code == 15 or channels > 10 or ss_code == 3:
+        return None
+    if (channels + 1 if channels < 8 else 2) != streaminfo.channels:
+        return None
+    if ss_code and FRAME_SAMPLE_SIZES[ss_code] != streaminfo.bits_per_sample:
+        return None
+    if 0 < sr_code < 12 and FRAME_SAMPLE_RATES[sr_code] != streaminfo.sample_rate:
+        return None
+
+    # The frame/sample number is coded like UTF-8 (with up to 36 bits)
+    first = b[4]
+    for extra, prefix in enumerate((0x80, 0xE0, 0xF0, 0xF8, 0xFC, 0xFE, 0xFF)):
+        if first < prefix:
+            break
+    else:
+        return None
+    if extra == 0:
+        number = first
+    elif extra == 1 and first < 0xC0:
+        return None
+    else:
+        number = first & (0x3F >> extra)
+    i = 5
+    for _ in range(extra):
+        if i >= len(b) or b[i] & 0xC0 != 0x80:
+            return None
+        number = (number << 6) | (b[i] & 0x3F)
+        i += 1
+
+    if bs_code == 1:
+        blocksize = 192
+    elif bs_code < 6:
+        blocksize = 576 << (bs_code - 2)
+    elif bs_code < 8:
+        size = bs_code - 5
+        blocksize = int.from_bytes(b[i:i + size], "big") + 1
+        i += size
+    else:
+        blocksize = 256 << (bs_code - 8)
+
+    i += {12: 1, 13: 2, 14: 2}.get(sr_code, 0)
+    if i >= len(b) or crc8(b[:i]) != b[i]:
+        return None
+
+    return i + 1, number, blocksize, bool(b[1] & 0x01)
+
+
+def find_frames(data, metadata):
+    """Find the audio frames by following the frame headers
+
+    returns ([(position, length, header length, block size)], the number of
+    samples, [problems that were found])
+    """
+    streaminfo = metadata.streaminfo
+    end = len(data)
+    errors = []
+
+    # Find all the valid frame headers
+    headers = []
+    for sync in (b"\xff\xf8", b"\xff\xf9"):
+        pos = data.find(sync, metadata.audio_offset)
+        while pos != -1:
+            header = parse_frame_header(data, pos, streaminfo)
+            if header is not None:
+                headers.append((pos,) + header)
+            pos = data.find(sync, pos + 1)
+    headers.sort()
+
+    if not headers:
+        return [], 0, ["No valid frames were found"]
+    if headers[0][0] != metadata.audio_offset:
+        errors.append("The audio doesn't start with a valid frame")
+
+    by_number = collections.defaultdict(list)
+    for i, (_, _, number, _, _) in enumerate(headers):
+        by_number[number].append(i)
+
+    # Follow the frames from one to the next, ignoring any headers
+    # that show up in the data that don't have the expected number
+    frames = []
+    samples = 0
+    missing = 0
+    i = 0
+    while True:
+        pos, header_len, number, blocksize, variable = headers[i]
+        samples += blocksize
+        expected = number + (blocksize if variable else 1)
+        nxt = next((j for j in by_number.get(expected, ()) if j > i), None)
+        if nxt is None:
+            nxt = next((j for j in range(i + 1, len(headers))
+                        if headers[j][2] > number), None)
+            if nxt is not None:
+                missing += 1
+                if missing == 1:
+                    errors.append("Lost sync after frame {} (sample {}) - data is missing or corrupt"
+                                  "".format(len(frames), samples))
+        if nxt is None:
+            frames.append((pos, end - pos, header_len, blocksize))
+            break
+        frames.append((pos, headers[nxt][0] - pos, header_len, blocksize))
+        i = nxt
+
+    if missing > 1:
+        errors.append("Lost sync {} times in total".format(missing))
+    return frames, samples, errors
+
+
+def bad_frames(data, frames):
+    """Get the indexes of the frames that fail the CRC-16 check"""
+    # The stored CRC-16 is the last 2 bytes of each frame
+    crcs = crc16_regions(data, [f[0] for f in frames], [max(f[1] - 2, 0) for f in frames])
+    return [n for n, ((p, l, _, _), crc) in enumerate(zip(frames, crcs))
+            if l < 2 or crc != int.from_bytes(data[p + l - 2:p + l], "big")]
+
+
+def verify_frames(path, metadata):
+    """Check the CRCs of every frame without decoding the audio
+
+    Checks the CRC-8 of each frame header, the CRC-16 of each frame, that no
+    frames are missing, and that the number of samples matches the STREAMINFO.
+
+    Returns a list of the problems that were found
+    """
+    streaminfo = metadata.streaminfo
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size <= metadata.audio_offset:
+            return ["The file doesn't contain any audio frames"]
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            frames, samples, errors = find_frames(mm, metadata)
+            if not frames:
+                return errors
+            bad = bad_frames(mm, frames)
+
+    if bad:
+        errors.append("{} frame(s) failed the CRC check (first at frame {})"
+                      "".format(len(bad), bad[0]))
+    if streaminfo.total_samples and samples != streaminfo.total_samples:
+        errors.append("Found {} samples but the STREAMINFO has {} - the file may be truncated"
+                      "".format(samples, streaminfo.total_samples))
+    return errors
+
+
+def _bit_windows(data):
+    """Get the 64 bits at every 16-bit offset of some data (big-endian)
+
+    Any 49 bits can then be read with a single lookup and shift.
+    """
+    data += bytes(8 + len(data) % 2)
+    return np.ndarray((len(data) // 2 - 3,), dtype=">u8", buffer=data, strides=(2,)).astype(np.uint64)
+
+
+def _read_bits(windows, pos, bits):
+    """Read an unsigned integer of 0-49 bits at each bit position"""
+    window = windows[pos >> 4] << (pos & 15).astype(np.uint64)
+    return ((window >> np.uint64(1)) >> (np.uint64(63) - np.asarray(bits, dtype=np.uint64))).astype(np.int64)
+
+
+def _read_signed(windows, pos, bits):
+    """Read a two's complement integer of 1-49 bits at each bit position"""
+    bits = np.asarray(bits, dtype=np.int64)
+    value = _read_bits(windows, pos, bits)
+    return value - (((value >> (bits - 1)) & 1) << bits)
+
+
+def _read_residual(windows, pos, k, escape_bits):
+    """Read a single residual without numpy (for the codes that are too long for
+    the vectorised Rice decoding, and escaped partitions)
+
+    returns (the residual as an unsigned Rice value, the position after it)
+    """
+    def read(pos, bits):
+        return (int(windows[pos >> 4]) >> (64 - (pos & 15) - bits)) & ((1 << bits) - 1)
+
+    if k is None:
+        value = read(pos, escape_bits)
+        if escape_bits and value >> (escape_bits - 1):
+            return 2 * ((1 << escape_bits) - value) - 1, pos + escape_bits
+        return 2 * value, pos + escape_bits
+
+    q = 0
+    while True:
+        window = read(pos, 32)
+        if window:
+            break
+        q += 32
+        pos += 32
+    zeros = 32 - window.bit_length()
+    q += zeros
+    pos += zeros + 1
+    return (q << k) | read(pos, k), pos + k
+
+
+def _decode_residual(windows, pos, blocksizes, order):
+    """Decode the Rice coded residuals of many subframes at once
+
+    The subframes are sorted by their number of residuals so each step decodes
+    one residual of every subframe that still has some left with the same
+    numpy operations. A new Rice parameter is read where each partition starts.
+
+    returns (the positions after the residuals, the residuals as an array of
+    (subframe, residual))
+    """
+    n = len(pos)
+    method = _read_bits(windows, pos, 2)
+    partition_order = _read_bits(windows, pos + 2, 4)
+    if np.any(method > 1):
+        raise ValueError("Reserved residual coding method")
+    partition_size = blocksizes >> partition_order
+    if np.any(partition_size << partition_order != blocksizes) or np.any(partition_size < order):
+        raise ValueError("Invalid residual partition order")
+
+    counts = blocksizes - order
+    rows = np.argsort(-counts, kind="stable")
+    counts = counts[rows]
+    pos = pos[rows] + 6
+    param_bits = 4 + method[rows]
+    escape = (1 << param_bits) - 1
+    k = np.zeros(n, dtype=np.uint64)
+    stop = np.ones(n, dtype=np.uint64)  # k + 1
+    remainder = np.full(n, 63, dtype=np.uint64)  # The shift to get the stop bit and remainder
+    escape_bits = np.zeros(n, dtype=np.int64)
+
+    def start_partitions(idx):
+        p = pos[idx]
+        param = _read_bits(windows, p, param_bits[idx])
+        p += param_bits[idx]
+        escaped = param == escape[idx]
+        # Escaped partitions are always read by _read_residual
+        k[idx] = np.where(escaped, 63, param)
+        stop[idx] = k[idx] + 1
+        remainder[idx] = 63 - k[idx]
+        escape_bits[idx] = np.where(escaped, _read_bits(windows, p, 5), 0)
+        pos[idx] = p + np.where(escaped, 5, 0)
+
+    # The first partition doesn't have any residuals if it only has the warm-up samples
+    partitions = 1 << partition_order[rows]
+    frame = np.repeat(np.arange(n), partitions)
+    number = np.arange(len(frame)) - np.repeat(np.cumsum(partitions) - partitions, partitions)
+    starts = number * partition_size[rows][frame] - order[rows][frame]
+    empty = (number == 0) & (partition_size[rows][frame] == order[rows][frame])
+    start_partitions(frame[empty])
+    frame, starts = frame[~empty], np.maximum(starts[~empty], 0)
+    by_start = np.argsort(starts, kind="stable")
+    steps, first = np.unique(starts[by_start], return_index=True)
+    schedule = dict(zip(steps.tolist(), np.split(frame[by_start], first[1:])))
+
+    length = int(counts[0]) if n else 0
+    active = np.searchsorted(-counts, -np.arange(length)).tolist()
+    residual = np.empty((length, n), dtype=np.uint64)
+    m = None
+    for t in range(length):
+        idx = schedule.get(t)
+        if idx is not None:
+            start_partitions(idx)
+        if active[t] != m:
+            m = active[t]
+            p, kk, rem, stp = pos[:m], k[:m], remainder[:m], stop[:m]
+        window = windows[p >> 4] << (p & 15).view(np.uint64)
+
+        # The unary part is the number of leading zeros: found from the float
+        # exponent of the top 53 bits (a long code gives a huge q instead)
+        q = 1075 - ((window >> 11).astype(np.float64).view(np.uint64) >> 52)
+        # The stop bit is followed by the k bits of the remainder
+        np.add((q - 1) << kk, (window << q) >> rem, out=residual[t, :m])
+        q += stp
+        if q.max() > 49:
+            slow = np.flatnonzero(q > 49)
+            for j, start in zip(slow.tolist(), p[slow].tolist()):
+                param = int(k[j])
+                residual[t, j], pos[j] = _read_residual(windows, start, None if param == 63 else param,
+                                                        int(escape_bits[j]))
+            q[slow] = 0
+        p += q.view(np.int64)
+
+    sign = residual & 1
+    residual >>= 1
+    residual ^= 0 - sign
+    result = np.empty(n, dtype=np.int64)
+    result[rows] = pos
+    # Index the (sorted) residuals by subframe
+    unsorted = np.empty(n, dtype=np.int64)
+    unsorted[rows] = np.arange(n)
+    return result, residual.view(np.int64).T[unsorted]
+
+
+def _decode_predicted(windows, pos, bits, blocksizes, order, lpc, size):
+    """Decode FIXED and LPC subframes
+
+    The FIXED predictions are undone here: the residuals are the differences
+    of the samples so they can be added back up with cumsum. The LPC ones are
+    left for _restore_lpc.
+
+    returns (the positions after the subframes, the samples as an array of
+    (subframe, sample), the LPC coefficients, the LPC shifts)
+    """
+    n = len(pos)
+    if np.any(order > blocksizes):
+        raise ValueError("The predictor order is larger than the block size")
+    max_order = int(order.max())
+    taps = np.arange(max_order)
+    used = taps < order[:, None]
+    warmup = _read_signed(windows, pos[:, None] + taps * bits[:, None] * used, bits[:, None])
+    pos = pos + order * bits
+
+    coefs = np.zeros((n, max_order), dtype=np.int64)
+    shift = np.zeros(n, dtype=np.int64)
+    idx = np.flatnonzero(lpc)
+    if len(idx):
+        precision = _read_bits(windows, pos[idx], 4) + 1
+        shift[idx] = _read_signed(windows, pos[idx] + 4, 5)
+        if np.any(precision == 16) or np.any(shift[idx] < 0):
+            raise ValueError("Invalid LPC precision or shift")
+        coefs[idx] = np.where(used[idx], _read_signed(
+            windows, (pos[idx] + 9)[:, None] + taps * precision[:, None] * used[idx], precision[:, None]), 0)
+        pos[idx] += 9 + order[idx] * precision
+
+    pos, residual = _decode_residual(windows, pos, blocksizes, order)
+
+    samples = np.empty((n, size), dtype=np.int64)
+    for o in np.unique(order).tolist():
+        idx = np.flatnonzero(order == o)
+        values = residual[idx, :size - o]
+        samples[idx, o:o + values.shape[1]] = values
+        samples[idx, :o] = warmup[idx, :o]
+
+        idx = idx[~lpc[idx]]
+        if o and len(idx):
+            # Start from the differences of the warm-up samples (as if they
+            # were preceded by zeros)
+            x = samples[idx]
+            for _ in range(o):
+                x[:, :o] = np.diff(x[:, :o], axis=1, prepend=0)
+            for _ in range(o):
+                np.cumsum(x, axis=1, out=x)
+            samples[idx] = x
+    return pos, samples, coefs, shift
+
+
+def _restore_lpc(samples, rows, order, coefs, shift):
+    """Add the LPC predictions to the residuals of some rows of samples (in place)
+
+    Each step predicts a sample of every subframe at once.
+    """
+    size = samples.shape[1]
+    taps = coefs.shape[1]
+    # Keep some zeros before each subframe so every prediction uses all the taps
+    history = np.zeros((len(rows), taps + size), dtype=np.int64)
+    history[:, taps:] = samples[rows]
+    coefs = coefs[:, ::-1]
+    for t in range(taps + int(order.min()), taps + size):
+        prediction = np.einsum("ij,ij->i", history[:, t - taps:t], coefs) >> shift
+        if t < 2 * taps:
+            prediction[order > t - taps] = 0
+        history[:, t] += prediction
+    samples[rows] = history[:, taps:]
+
+
+def _decode_subframes(windows, pos, bits, blocksizes, out):
+    """Decode one channel of many frames into out (an array of (frame, sample))
+
+    bits is the sample size of the channel in each frame (the side channel
+    has an extra bit)
+
+    returns (the positions after the subframes, the wasted bits of each
+    subframe, (the LPC subframes, their orders, coefficients and shifts))
+    """
+    n, size = out.shape
+    header = _read_bits(windows, pos, 8)
+    if np.any(header & 0x80):
+        raise ValueError("Invalid subframe header")
+    kind = (header >> 1) & 0x3F
+    pos = pos + 8
+
+    # The number of wasted bits is coded in unary
+    wasted = np.zeros(n, dtype=np.int64)
+    idx = np.flatnonzero(header & 1)
+    if len(idx):
+        window = _read_bits(windows, pos[idx], 32)
+        wasted[idx] = 33 - np.frexp(window.astype(np.float64))[1]
+        pos[idx] += wasted[idx]
+    bits = bits - wasted
+    if np.any(bits < 1):
+        raise ValueError("Invalid number of wasted bits")
+
+    idx = np.flatnonzero(kind == 0)
+    if len(idx):
+        # CONSTANT
+        out[idx] = _read_signed(windows, pos[idx], bits[idx])[:, None]
+        pos[idx] += bits[idx]
+
+    idx = np.flatnonzero(kind == 1)
+    if len(idx):
+        # VERBATIM
+        used = np.arange(size) < blocksizes[idx, None]
+        offsets = np.arange(size) * bits[idx, None] * used
+        out[idx] = _read_signed(windows, pos[idx, None] + offsets, bits[idx, None])
+        pos[idx] += bits[idx] * blocksizes[idx]
+
+    fixed = (kind >= 8) & (kind <= 12)
+    lpc = kind >= 32
+    if np.any((kind > 1) & ~fixed & ~lpc):
+        raise ValueError("Reserved subframe type")
+    order = np.where(lpc, kind - 31, kind - 8)
+    idx = np.flatnonzero(fixed | lpc)
+    coefs = shift = None
+    if len(idx):
+        pos[idx], out[idx], coefs, shift = _decode_predicted(windows, pos[idx], bits[idx], blocksizes[idx],
+                                                             order[idx], lpc[idx], size)
+        lpc = lpc[idx]
+        idx, coefs, shift = idx[lpc], coefs[lpc], shift[lpc]
+    return pos, wasted, (idx, order[idx], coefs, shift)
+
+
+def _decode_frames(data, frames, streaminfo):
+    """Decode a batch of frames in lockstep
+
+    frames is a list of (position, length, header length, block size) from
+    find_frames. Every step of the decoding is done for all the frames at
+    once by numpy, like crc16_regions.
+
+    returns the samples as an array of (frame, sample, channel) and the block
+    sizes, raises ValueError if the frames can't be decoded
+    """
+    start = frames[0][0]
+    region = data[start:frames[-1][0] + frames[-1][1]]
+    windows = _bit_windows(region)
+
+    n = len(frames)
+    offsets = np.array([f[0] - start for f in frames], dtype=np.int64)
+    ends = offsets + [f[1] for f in frames]
+    pos = (offsets + [f[2] for f in frames]) * 8
+    blocksizes = np.array([f[3] for f in frames], dtype=np.int64)
+    assignment = np.array([data[f[0] + 3] >> 4 for f in frames])
+
+    samples = np.empty((streaminfo.channels, n, int(blocksizes.max())), dtype=np.int64)
+    wasted = np.empty((streaminfo.channels, n, 1), dtype=np.int64)
+    predictors = []
+    for channel, out in enumerate(samples):
+        side = np.isin(assignment, (9,) if channel == 0 else (8, 10) if channel == 1 else ())
+        pos, wasted[channel, :, 0], (idx, order, coefs, shift) = _decode_subframes(
+            windows, pos, streaminfo.bits_per_sample + side, blocksizes, out)
+        if len(idx):
+            predictors.append((idx + channel * n, order, coefs, shift))
+
+    # Then there's the padding to a whole byte and the CRC-16
+    if np.any((pos + 7) >> 3 != ends - 2):
+        raise ValueError("The subframes don't fill the frame")
+
+    if predictors:
+        # Undo the LPC predictions of all the channels at once
+        rows, order, coefs, shift = zip(*predictors)
+        taps = max(c.shape[1] for c in coefs)
+        coefs = np.concatenate([np.pad(c, ((0, 0), (0, taps - c.shape[1]))) for c in coefs])
+        rows, order, shift = np.concatenate(rows), np.concatenate(order), np.concatenate(shift)
+        _restore_lpc(samples.reshape(-1, samples.shape[2]), rows, order, coefs, shift)
+    samples <<= wasted
+
+    if streaminfo.channels == 2:
+        left, right = samples
+        idx = np.flatnonzero(assignment == 8)
+        right[idx] = left[idx] - right[idx]
+        idx = np.flatnonzero(assignment == 9)
+        left[idx] += right[idx]
+        idx = np.flatnonzero(assignment == 10)
+        mid = (left[idx] << 1) | (right[idx] & 1)
+        left[idx] = (mid + right[idx]) >> 1
+        right[idx] = (mid - right[idx]) >> 1
+
+    return samples.transpose(1, 2, 0), blocksizes
+
+
+def decode_flac(path, metadata, consumers):
+    """Decode a file without flac and pass the audio to some PCMConsumers
+
+    Slower than flac, but it means files can be verified without it. The
+    frames are decoded DECODE_BATCH_FRAMES at a time (see _decode_frames).
+
+    returns if the file was decoded without any errors
+    """
+    streaminfo = metadata.streaminfo
+    dtype = "<i{}".format(4 if streaminfo.bits_per_sample > 16 else (streaminfo.bits_per_sample + 7) // 8)
+    with PROFILER.timed("decode_flac"), open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size <= metadata.audio_offset:
+            return False
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            frames, total, errors = find_frames(mm, metadata)
+            if errors or bad_frames(mm, frames):
+                return False
+            if streaminfo.total_samples and total != streaminfo.total_samples:
+                return False
+
+            for i in range(0, len(frames), DECODE_BATCH_FRAMES):
+                try:
+                    samples, blocksizes = _decode_frames(mm, frames[i:i + DECODE_BATCH_FRAMES], streaminfo)
+                except (ValueError, IndexError):
+                    return False
+                pcm = np.empty(samples.shape, dtype=dtype)
+                pcm[:] = samples
+                if np.any(blocksizes != samples.shape[1]):
+                    pcm = pcm[np.arange(samples.shape[1]) < blocksizes[:, None]]
+                if streaminfo.bits_per_sample in range(17, 25):
+                    # Drop the top byte of each sample
+                    pcm = pcm.view(np.uint8).reshape(-1, 4)[:, :3]
+                data = pcm.tobytes()
+                for consumer in consumers:
+                    consumer.update(data)
+    return True
+
+
+def pcm_samples(data, width):
+    """Convert little-endian signed samples to a sequence of ints"""
+    if np is not None:
+        if width == 3:
+            b = np.frombuffer(data, dtype=np.uint8).reshape(-1, 3).astype(np.int32)
+            return ((b[:, 0] << 8) | (b[:, 1] << 16) | (b[:, 2] << 24)) >> 8
+        return np.frombuffer(data, dtype="<i{}".format(width))
+    if width == 3:
+        return [int.from_bytes(data[i:i + 3], "little", signed=True)
+                for i in range(0, len(data), 3)]
+    samples = array.array({1: "b", 2: "h", 4: "i"}[width])
+    samples.frombytes(data)
+    if sys.byteorder != "little":
+        samples.byteswap()
+    return samples
+
+
+class PCMConsumer(object):
+    """Base class for the checks that process the decoded audio of a track
+
+    The audio is passed in as chunks of interleaved, little-endian, signed
+    samples (the format the STREAMINFO MD5 is calculated from). Each chunk
+    only contains whole samples and is only valid during the call.
+    """
+
+    name = None
+
+    def __init__(self, streaminfo):
+        self.streaminfo = streaminfo
+        self.width = (streaminfo.bits_per_sample + 7) // 8
+
+    def update(self, data):
+        raise NotImplementedError()
+
+    def result(self):
+        """Get a JSON-serializable result (it's cached)"""
+        raise NotImplementedError()
+
+
+class MD5Consumer(PCMConsumer):
+    """The MD5 of the audio
+
+    Checked against the STREAMINFO, and also used to find tracks with the same
+    audio (even when the STREAMINFO doesn't have an MD5).
+    """
+
+    name = "md5"
+
+    def __init__(self, streaminfo):
+        super().__init__(streaminfo)
+        self._md5 = hashlib.md5()
+
+    def update(self, data):
+        self._md5.update(data)
+
+    def result(self):
+        return self._md5.hexdigest()
+
+
+class PeakConsumer(PCMConsumer):
+    """The sample peak as a fraction of full scale (like REPLAYGAIN_TRACK_PEAK)"""
+
+    name = "peak"
+
+    def __init__(self, streaminfo):
+        super().__init__(streaminfo)
+        self._peak = 0
+
+    def update(self, data):
+        samples = pcm_samples(data, self.width)
+        if not len(samples):
+            return
+        if np is not None:
+            self._peak = max(self._peak, int(samples.max()), -int(samples.min()))
+        else:
+            self._peak = max(self._peak, max(samples), -min(samples))
+
+    def result(self):
+        return self._peak / (1 << (self.streaminfo.bits_per_sample - 1))
+
+
+# ReplayGain 1.0 (what `metaflac --add-replay-gain` uses)
+REPLAYGAIN_FILTERS = {  # sample rate: ((yule b, yule a), (butterworth b, butterworth a))
+    44100: (
+        ((0.05418656406430, -0.02911007808948, -0.00848709379851, -0.00851165645469,
+          -0.00834990904936, 0.02245293253339, -0.02596338512915, 0.01624864962975,
+          -0.00240879051584, 0.00674613682247, -0.00187763777362),
+         (1.0, -3.47845948550071, 6.36317777566148, -8.54751527471874, 9.47693607801280,
+          -8.81498681370155, 6.85401540936998, -4.39470996079559, 2.19611684890774,
+          -0.75104302451432, 0.13149317958808)),
+        ((0.98500175787242, -1.97000351574484, 0.98500175787242),
+         (1.0, -1.96977855582618, 0.97022847566350)),
+    ),
+    48000: (
+        ((0.03857599435200, -0.02160367184185, -0.00123395316851, -0.00009291677959,
+          -0.01655260341619, 0.02161526843274, -0.02074045215285, 0.00594298065125,
+          0.00306428023191, 0.00012025322027, 0.00288463683916),
+         (1.0, -3.84664617118067, 7.81501653005538, -11.34170355132042, 13.05504219327545,
+          -12.28759895145294, 9.48293806319790, -5.87257861775999, 2.75465861874613,
+          -0.86984376593551, 0.13919314567432)),
+        ((0.98621192462708, -1.97242384925416, 0.98621192462708),
+         (1.0, -1.97223372919527, 0.97261396931306)),
+    ),
+}
+REPLAYGAIN_IR_LENGTH = 2048  # The filters decay to nothing well within this
+REPLAYGAIN_FFT_SIZE = 1 << 14
+REPLAYGAIN_WINDOW = 0.05
+REPLAYGAIN_STEPS_PER_DB = 100
+REPLAYGAIN_MAX_DB = 120
+REPLAYGAIN_PERCENTILE = 0.95
+REPLAYGAIN_PINK_REF = 64.82
+
+
+@functools.lru_cache(maxsize=None)
+def _replaygain_filter(sample_rate):
+    """Get the impulse response of the ReplayGain equal loudness filter"""
+    ir = [1.0] + [0.0] * (REPLAYGAIN_IR_LENGTH - 1)
+    for b, a in REPLAYGAIN_FILTERS[sample_rate]:
+        x, ir = ir, []
+        for n in range(len(x)):
+            y = sum(b[k] * x[n - k] for k in range(min(n + 1, len(b))))
+            y -= sum(a[k] * ir[n - k] for k in range(1, min(n + 1, len(a))))
+            ir.append(y)
+    return np.array(ir)
+
+
+def replaygain(histogram):
+    """Get the gain from a histogram of the loudness of 50ms windows
+
+    returns None if there isn't enough audio
+    """
+    count = int(histogram.sum())
+    if not count:
+        return None
+    upper = math.ceil(count * (1 - REPLAYGAIN_PERCENTILE))
+    i = len(histogram) - 1 - int(np.argmax(np.cumsum(histogram[::-1]) >= upper))
+    return REPLAYGAIN_PINK_REF - i / REPLAYGAIN_STEPS_PER_DB
+
+
+def decode_histogram(value):
+    """Decode a histogram that was stored by ReplayGainConsumer"""
+    start, data = value
+    counts = np.frombuffer(zlib.decompress(base64.b64decode(data)), dtype="<u4")
+    histogram = np.zeros(REPLAYGAIN_STEPS_PER_DB * REPLAYGAIN_MAX_DB, dtype=np.int64)
+    histogram[start:start + len(counts)] = counts
+    return histogram
+
+
+class ReplayGainConsumer(PCMConsumer):
+    """The ReplayGain 1.0 track gain and loudness histogram (for the album gain)
+
+    The equal loudness filter is applied as an FFT convolution with its
+    impulse response instead of sample by sample. Requires numpy.
+    """
+
+    name = "replaygain"
+
+    def __init__(self, streaminfo):
+        super().__init__(streaminfo)
+        self.supported = streaminfo.sample_rate in REPLAYGAIN_FILTERS and streaminfo.channels <= 2
+        if not self.supported:
+            return
+
+        # Overlap-add convolution: the audio is filtered in blocks that fit in
+        # the FFT with the impulse response
+        self._block = REPLAYGAIN_FFT_SIZE - REPLAYGAIN_IR_LENGTH + 1
+        self._fft = np.fft.rfft(_replaygain_filter(streaminfo.sample_rate), REPLAYGAIN_FFT_SIZE)
+        self._tail = np.zeros((streaminfo.channels, REPLAYGAIN_IR_LENGTH - 1))
+        self._pending = np.zeros(0)  # The energy of the samples that aren't in a full window
+        self._window = math.ceil(streaminfo.sample_rate * REPLAYGAIN_WINDOW)
+        self._histogram = np.zeros(REPLAYGAIN_STEPS_PER_DB * REPLAYGAIN_MAX_DB, dtype=np.int64)
+
+    def update(self, data):
+        if not self.supported:
+            return
+
+        # The filters expect samples in the range of 16 bit audio
+        x = pcm_samples(data, self.width).reshape(-1, self.streaminfo.channels).T
+        x = x * 2.0 ** (16 - self.streaminfo.bits_per_sample)
+
+        channels, frames = x.shape
+        blocks = -(-frames // self._block)
+        padded = np.zeros((channels, blocks * self._block))
+        padded[:, :frames] = x
+        out = np.fft.irfft(np.fft.rfft(padded.reshape(channels, blocks, self._block),
+                                       REPLAYGAIN_FFT_SIZE) * self._fft, REPLAYGAIN_FFT_SIZE)
+
+        # The end of each block's output overlaps the start of the next one
+        y = np.zeros((channels, (blocks + 1) * self._block))
+        y[:, :-self._block] = out[:, :, :self._block].reshape(channels, -1)
+        tails = np.zeros((channels, blocks, self._block))
+        tails[:, :, :REPLAYGAIN_IR_LENGTH - 1] = out[:, :, self._block:]
+        y[:, self._block:] += tails.reshape(channels, -1)
+        y[:, :REPLAYGAIN_IR_LENGTH - 1] += self._tail
+        self._tail = y[:, frames:frames + REPLAYGAIN_IR_LENGTH - 1]
+
+        energy = np.concatenate((self._pending, np.mean(y[:, :frames] ** 2, axis=0)))
+        full = len(energy) - len(energy) % self._window
+        self._pending = energy[full:]
+        windows = energy[:full].reshape(-1, self._window).mean(axis=1)
+        steps = (REPLAYGAIN_STEPS_PER_DB * 10 * np.log10(windows + 1e-37)).astype(np.int64)
+        self._histogram += np.bincount(np.clip(steps, 0, len(self._histogram) - 1),
+                                       minlength=len(self._histogram))
+
+    def result(self):
+        if not self.supported:
+            return None
+
+        used = np.flatnonzero(self._histogram)
+        if not len(used):
+            return {"gain": None, "histogram": [0, ""]}
+        counts = self._histogram[used[0]:used[-1] + 1].astype("<u4").tobytes()
+        return {
+            "gain": replaygain(self._histogram),
+            "histogram": [int(used[0]), base64.b64encode(zlib.compress(counts)).decode("ascii")],
+        }
+
+
+AR_SKIP = 5 * 588  # AccurateRip ignores 5 sectors at the start and end of a disc
+
+
+def _accuraterip_sums(words, start):
+    """Sum the low and high 32 bits of each sample multiplied by its position"""
+    product = words.astype(np.uint64) * np.arange(start, start + len(words), dtype=np.uint64)
+    return [int((product & np.uint64(0xFFFFFFFF)).sum()) % 2 ** 32,
+            int((product >> np.uint64(32)).sum()) % 2 ** 32]
+
+
+def accuraterip_checksums(result, first, last):
+    """Get the AccurateRip checksums from the result of an AccurateRipConsumer
+
+    The samples AccurateRip ignores depend on where the track is on the disc.
+
+    returns (v1, v2)
+    """
+    low, high = result["sums"]
+    for skip, ignored in ((first, "head"), (last, "tail")):
+        if skip:
+            low -= result[ignored][0]
+            high -= result[ignored][1]
+    return low % 2 ** 32, (low + high) % 2 ** 32
+
+
+class AccurateRipConsumer(PCMConsumer):
+    """The CRC32 and AccurateRip checksums of CD audio (like in rip logs)
+
+    Keeps the sums of the samples that AccurateRip ignores for the first and
+    last tracks separate so accuraterip_checksums can handle either. Requires
+    numpy.
+    """
+
+    name = "accuraterip"
+
+    def __init__(self, streaminfo):
+        super().__init__(streaminfo)
+        self.supported = (streaminfo.sample_rate, streaminfo.channels, streaminfo.bits_per_sample) == (44100, 2, 16)
+        self._crc32 = 0
+        self._count = 0
+        self._sums = [0, 0]
+        self._head = [0, 0]
+        self._last = np.zeros(0, dtype=np.uint32)
+
+    def update(self, data):
+        if not self.supported:
+            return
+
+        self._crc32 = zlib.crc32(data, self._crc32)
+
+        # Each sample is a 32 bit word of the left (low) and right (high) channel
+        words = np.frombuffer(data, dtype="<u4")
+        start = self._count + 1
+        self._sums = [x + y for x, y in zip(self._sums, _accuraterip_sums(words, start))]
+        if start < AR_SKIP:
+            head = _accuraterip_sums(words[:AR_SKIP - start], start)
+            self._head = [x + y for x, y in zip(self._head, head)]
+        self._count += len(words)
+        self._last = np.concatenate((self._last, words))[-AR_SKIP:]
+
+    def result(self):
+        if not self.supported:
+            return None
+        return {
+            "crc32": self._crc32,
+            "sums": self._sums,
+            "head": self._head,
+            "tail": _accuraterip_sums(self._last, self._count - len(self._last) + 1),
+        }
+
+
+PCM_CONSUMERS = (MD5Consumer, PeakConsumer)
+
+
+def pcm_consumers(config):
+    """Get the PCMConsumers to use"""
+    ret = PCM_CONSUMERS
+    if config.verify_replaygain:
+        ret += (ReplayGainConsumer,)
+    if config.verify_log:
+        ret += (AccurateRipConsumer,)
+    return ret
+
+
+def read_text(path):
+    """Read a text file that could be in UTF-16 (EAC logs), UTF-8, or a legacy encoding"""
+    with open(path, "rb") as f:
+        data = f.read()
+    if data.startswith((b"\xff\xfe", b"\xfe\xff")):
+        return data.decode("utf-16")
+    try:
+        return data.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        return data.decode("cp1252", "replace")
+
+
+def parse_rip_log(path):
+    """Get the checksums of each track from an EAC or XLD log
+
+    returns {track number: {"crc32": int, "accuraterip": {version: int}}}
+    """
+    tracks = collections.defaultdict(lambda: {"crc32": None, "accuraterip": {}})
+    track = None
+    for line in read_text(path).splitlines():
+        m = LOG_TRACK_REGEX.match(line)
+        if m:
+            track = int(m.group(1))
+            continue
+
+        m = LOG_EAC_AR_REGEX.match(line)
+        if m:
+            # Also in the summary at the end of EAC logs (with the track number)
+            number = int(m.group(1)) if m.group(1) else track
+            if number is not None:
+                tracks[number]["accuraterip"][int(m.group(3) or 1)] = int(m.group(2), 16)
+            continue
+
+        if track is None:
+            continue
+        m = LOG_CRC32_REGEX.match(line)
+        if m:
+            tracks[track]["crc32"] = int(m.group(1), 16)
+            continue
+        m = LOG_XLD_AR_REGEX.match(line)
+        if m:
+            tracks[track]["accuraterip"][int(m.group(1))] = int(m.group(2), 16)
+
+    return dict(tracks)
+
+
+def parse_cue_tracks(path):
+    """Get the numbers of the audio tracks in a cue sheet"""
+    return [int(m.group(1)) for m in map(CUE_TRACK_REGEX.match, read_text(path).splitlines()) if m]
+
+
+def decode_pcm(path, metadata, consumers):
+    """Decode a file with flac and pass the audio to some PCMConsumers
+
+    The audio is streamed through a fixed-size buffer so the memory use
+    doesn't depend on the length of the track.
+
+    returns if the file was decoded without any errors
+    """
+    streaminfo = metadata.streaminfo
+    frame_size = (streaminfo.bits_per_sample + 7) // 8 * streaminfo.channels
+    buf = bytearray(PCM_BUFFER_SIZE - PCM_BUFFER_SIZE % frame_size)
+    view = memoryview(buf)
+
+    cmd = ("flac", "--decode", "--stdout", "--silent", "--force-raw-format",
+           "--endian=little", "--sign=signed", path)
+    with PROFILER.timed("flac --decode", subprocess=True):
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        with proc.stdout:
+            while True:
+                size = 0
+                while size < len(buf):
+                    n = proc.stdout.readinto(view[size:])
+                    if not n:
+                        break
+                    size += n
+                if size:
+                    for consumer in consumers:
+                        consumer.update(view[:size])
+                if size < len(buf):
+                    break
+        return proc.wait() == 0
+
+
+def analyse_audio(path, metadata, consumers=PCM_CONSUMERS):
+    """Decode a file once and run some PCMConsumers on it
+
+    Uses the built-in decoder if flac isn't installed.
+
+    returns (if it decoded and matched the STREAMINFO MD5, {name: result})
+    The results are None if the file couldn't be verified.
+    """
+    consumers = [x(metadata.streaminfo) for x in consumers]
+    decode = decode_pcm if EXTERNALS["flac"] else decode_flac
+    if not decode(path, metadata, consumers):
+        return False, None
+
+    audio = {x.name: x.result() for x in consumers}
+    if metadata.has_md5 and audio["md5"] != metadata.streaminfo.md5.hex():
+        return False, None
+    return True, audio
+
+
+class VerificationCache(object):
+    """On-disk cache of the results of the flac tests
+
+    Entries are keyed on the path of the file and are only used if its size,
+    mtime, inode, and STREAMINFO MD5 haven't changed since they were stored.
+
+    Also holds the index of the STREAMINFO MD5s of the tracks in the library
+    that's used to find duplicates, and the index of the artist and label
+    names used to find different spellings of them.
+    """
+
+    VERSION = 3
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        with self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            if self._conn.execute("PRAGMA user_version").fetchone()[0] != self.VERSION:
+                # Cached results are cheap to regenerate - just start over
+                self._conn.execute("DROP TABLE IF EXISTS tracks")
+                self._conn.execute("DROP TABLE IF EXISTS audio")
+                self._conn.execute("DROP TABLE IF EXISTS names")
+                self._conn.execute("PRAGMA user_version = {:d}".format(self.VERSION))
+            self._conn.execute("CREATE TABLE IF NOT EXISTS tracks ("
+                               "path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, "
+                               "inode INTEGER, md5 BLOB, verified INTEGER, audio TEXT, "
+                               "last_used REAL)")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS audio ("
+                               "path TEXT PRIMARY KEY, album TEXT, md5 BLOB, samples INTEGER)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS audio_md5 ON audio (md5, samples)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS audio_album ON audio (album)")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS names ("
+                               "album TEXT, tag TEXT, kind TEXT, key TEXT, value TEXT)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS names_key ON names (kind, key)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS names_album ON names (album)")
+
+    @staticmethod
+    def file_key(path, md5):
+        """Get the values that identify the current state of a file"""
+        st = os.stat(path)
+        return (st.st_size, st.st_mtime_ns, st.st_ino, md5)
+
+    def get(self, path, key):
+        """Get the cached results of a file
+
+        Returns (verified, audio analysis or None) or None if the file isn't
+        cached or has changed
+        """
+        with self._lock, self._conn:
+            row = self._conn.execute("SELECT size, mtime, inode, md5, verified, audio "
+                                     "FROM tracks WHERE path = ?", (path,)).fetchone()
+            if row is None or tuple(row[:4]) != key:
+                return None
+            self._conn.execute("UPDATE tracks SET last_used = ? WHERE path = ?",
+                               (time.time(), path))
+
+        return bool(row[4]), (json.loads(row[5]) if row[5] is not None else None)
+
+    def put(self, path, key, verified, audio=None):
+        if audio is not None:
+            audio = json.dumps(audio)
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO tracks VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                               (path,) + key + (verified, audio, time.time()))
+
+    def update_audio(self, album, tracks):
+        """Replace the tracks of an album in the audio index
+
+        tracks is a list of (path, STREAMINFO MD5, number of samples)
+
+        returns {path: [(other album, other path)]} of the tracks in other
+        albums with the same audio
+        """
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM audio WHERE album = ?", (album,))
+            self._conn.executemany("INSERT OR REPLACE INTO audio VALUES (?, ?, ?, ?)",
+                                   [(p, album, md5, samples) for p, md5, samples in tracks])
+            ret = {}
+            for path, md5, samples in tracks:
+                ret[path] = self._conn.execute("SELECT album, path FROM audio WHERE md5 = ? AND "
+                                               "samples = ? AND album != ? ORDER BY path",
+                                               (md5, samples, album)).fetchall()
+
+        # Forget about files that were removed since they were indexed
+        stale = {p for matches in ret.values() for _, p in matches if not os.path.exists(p)}
+        if stale:
+            with self._lock, self._conn:
+                self._conn.executemany("DELETE FROM audio WHERE path = ?", [(x,) for x in stale])
+        return {k: [tuple(x) for x in v if x[1] not in stale] for k, v in ret.items()}
+
+    def update_names(self, album, names):
+        """Replace the names of an album in the spelling index
+
+        names is a list of (tag, value) where the tag is one of SPELLING_TAGS
+
+        returns {(tag, value): [(other album, other value)]} of the names in
+        other albums that are spelled differently
+        """
+        rows = [(album, tag, SPELLING_TAGS[tag], name_key(value), value) for tag, value in names]
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM names WHERE album = ?", (album,))
+            self._conn.executemany("INSERT INTO names VALUES (?, ?, ?, ?, ?)", rows)
+            ret = {}
+            for _, tag, kind, key, value in rows:
+                ret[(tag, value)] = self._conn.execute("SELECT DISTINCT album, value FROM names WHERE "
+                                                       "kind = ? AND key = ? AND value != ? AND "
+                                                       "album != ? ORDER BY album, value",
+                                                       (kind, key, value, album)).fetchall()
+
+        # Forget about albums that were removed since they were indexed
+        stale = {a for matches in ret.values() for a, _ in matches if not os.path.isdir(a)}
+        if stale:
+            with self._lock, self._conn:
+                self._conn.executemany("DELETE FROM names WHERE album = ?", [(x,) for x in stale])
+        return {k: [tuple(x) for x in v if x[0] not in stale] for k, v in ret.items()}
+
+    def clear(self):
+        """Remove the cached results (the indexes of the library are kept)"""
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM tracks")
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits in its max size
+
+        Only the cached results count towards the size - the indexes of the
+        library are never evicted.
+        """
+        with self._lock:
+            # Estimate the size from the data (the fixed size columns and the
+            # overhead of each row are about 64 bytes)
+            count, size = self._conn.execute("SELECT COUNT(*), IFNULL(SUM(LENGTH(path) + "
+                                             "IFNULL(LENGTH(audio), 0) + 64), 0) "
+                                             "FROM tracks").fetchone()
+            if size <= self.max_size:
+                return
+
+            # Shrink to 3/4 of the max size so this doesn't need to happen every run
+            remove = count - int(count * self.max_size * 0.75 / size)
+            with self._conn:
+                self._conn.execute("DELETE FROM tracks WHERE path IN ("
+                                   "SELECT path FROM tracks ORDER BY last_used LIMIT ?)",
+                                   (remove,))
+            self._conn.execute("VACUUM")
+
+
+class Journal(object):
+    """Append-only journal of the albums that were checked (for --resume)
+
+    Each line is a JSON object with an album's directory, a fingerprint of its
+    files and the options it was checked with, and what was printed for it.
+    Lines are written as each album finishes but only synced to the disk every
+    JOURNAL_SYNC_INTERVAL seconds so a crash only loses the last few albums
+    (which are checked again). Incomplete lines are ignored.
+    """
+
+    def __init__(self, path):
+        self.entries = {}
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            data = b""
+        for line in data.splitlines():
+            try:
+                entry = json.loads(line.decode("utf-8"))
+            except ValueError:
+                continue
+            if isinstance(entry, dict) and "album" in entry:
+                self.entries[entry["album"]] = entry
+
+        self._file = open(path, "ab")
+        if not data.endswith(b"\n") and data:
+            # Don't append to an incomplete line
+            self._file.write(b"\n")
+        self._synced = time.monotonic()
+
+    def get(self, directory):
+        """Get the last entry for an album (or None)"""
+        return self.entries.get(os.path.abspath(directory))
+
+    def record(self, entry):
+        self.entries[entry["album"]] = entry
+        self._file.write(json.dumps(entry).encode("utf-8") + b"\n")
+        self._file.flush()
+        if time.monotonic() - self._synced >= JOURNAL_SYNC_INTERVAL:
+            self.sync()
+
+    def sync(self):
+        os.fsync(self._file.fileno())
+        self._synced = time.monotonic()
+
+    def close(self):
+        self.sync()
+        self._file.close()
+
+
+def album_fingerprint(directory):
+    """Get a digest of the names, sizes, and modification times of an album's files"""
+    digest = hashlib.sha1()
+    for dirpath, _, files in walk_dirs(directory):
+        for name in files:
+            path = os.path.join(dirpath, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            digest.update("{}\0{}\0{}\n".format(os.path.relpath(path, directory), st.st_size,
+                                                st.st_mtime_ns).encode("utf-8", "surrogateescape"))
+    return digest.hexdigest()
+
+
+def open_cache(path, max_size):
+    """Get the (shared) verification cache stored at the path
+
+    SQLite connections can't be shared with forked processes so each process
+    gets its own.
+    """
+    return _open_cache(path, max_size, os.getpid())
+
+
+@functools.lru_cache(maxsize=None)
+def _open_cache(path, max_size, pid):
+    return VerificationCache(path, max_size)
+
+
 class Date(object):
     """Class to hold date information
 
@@ -213,6 +2234,11 @@ class Date(object):
     @staticmethod
     def parse(s):
         """Parse an ISO-formatted date"""
+        with PROFILER.timed("Date.parse"):
+            return Date._parse(s)
+
+    @staticmethod
+    def _parse(s):
         if s is None:
             return None
         with contextlib.suppress(ValueError):
@@ -256,11 +2282,153 @@ class Level(enum.Enum):
         raise ValueError("Object '{!r}' is not a Level".format(obj))
 
 
+class Severity(enum.Enum):
+    info = "info"  # Something was fixed
+    warning = "warning"  # Something couldn't be checked
+    error = "error"
+
+    def __str__(self):
+        return str(self.value)
+
+
+# elapsed is the number of seconds since the album started being validated
+Finding = collections.namedtuple("Finding", ("check", "level", "path", "tag", "severity", "message", "elapsed"))
+
+
+class TextSink(object):
+    """Prints the message of each finding under a header for each item"""
+
+    def start(self, item):
+        if item.name is None:
+            print("Validating the only {}".format(item.level))
+        else:
+            print("Validating {}".format(item))
+
+    def report(self, finding):
+        print(finding.message)
+
+    def finish(self, album):
+        pass
+
+
+class JSONLinesSink(object):
+    """Prints each finding as a line of JSON, flushed after each album"""
+
+    def start(self, item):
+        pass
+
+    def report(self, finding):
+        record = finding._asdict()
+        record["level"] = str(finding.level)
+        record["severity"] = str(finding.severity)
+        print(json.dumps(record))
+
+    def finish(self, album):
+        sys.stdout.flush()
+
+
+class ListSink(object):
+    """Collects the findings in a list instead of printing them"""
+
+    def __init__(self):
+        self.findings = []
+
+    def start(self, item):
+        pass
+
+    def report(self, finding):
+        self.findings.append(finding)
+
+    def finish(self, album):
+        pass
+
+
+SINKS = {"text": TextSink, "jsonl": JSONLinesSink}
+
+
+class TagIndex(object):
+    """Columnar index of the tags of every track in an album
+
+    Each tag maps to a column with the (first) value of that tag for every
+    track in album order, with None where a track doesn't have it. Discs and
+    tracks are contiguous spans of the tracks so any lookup is a slice of a
+    column, and the summaries of the slices are cached. Tracks that couldn't be
+    read are left out of the lookups.
+    """
+
+    def __init__(self, tracks):
+        self.size = len(tracks)
+        self.columns = {}
+        self.duplicates = collections.defaultdict(list)  # tag -> [(position, values)]
+        self._summaries = {}
+        self._tag_lists = {}
+
+        for i, track in enumerate(tracks):
+            for tag, values in track.tags.items():
+                if not values:
+                    continue
+                column = self.columns.get(tag)
+                if column is None:
+                    column = self.columns[tag] = [None] * self.size
+                column[i] = values[0]
+                if len(values) > 1:
+                    self.duplicates[tag].append((i, values))
+        self.unreadable = {i for i, track in enumerate(tracks) if track.error is not None}
+
+    def values(self, tag, start, stop):
+        """Get the value of a tag for each readable track in the span (None if missing)"""
+        column = self.columns.get(tag)
+        values = [None] * (stop - start) if column is None else column[start:stop]
+        if self.unreadable:
+            values = [x for i, x in enumerate(values, start) if i not in self.unreadable]
+        return values
+
+    def find_duplicates(self, tag, start, stop):
+        """Get the (position, values) of the tracks in the span with duplicate tags"""
+        return [x for x in self.duplicates.get(tag, ()) if start <= x[0] < stop]
+
+    def summary(self, tag, start, stop):
+        """Get the (distinct values, number missing) of a tag in the span"""
+        key = (tag, start, stop)
+        summary = self._summaries.get(key)
+        if summary is None:
+            values = self.values(tag, start, stop)
+            summary = self._summaries[key] = (frozenset(values), values.count(None))
+        return summary
+
+    def tags(self, start, stop):
+        """Get all the different tags in the span"""
+        key = (start, stop)
+        tags = self._tag_lists.get(key)
+        if tags is None:
+            tags = self._tag_lists[key] = frozenset(
+                t for t, c in self.columns.items()
+                if any(x is not None for x in c[start:stop])
+            )
+        return tags
+
+
 class ValidatorBase(object):
 
+    __slots__ = ()
+
     REQUIRED_TAGS = set()
     REPLAYGAIN_TAGS = set()
 
+    def report(self, check, message, tag=None, severity=Severity.error, fix=None):
+        """Report a finding about this item to the sink
+
+        fix is how to fix the tags (see fix_comments) with --fix. It's applied
+        to every track in the album since each tag is only reported once (and
+        only changes the tracks that need it).
+        """
+        path = self.path if self.level is Level.track else self.directory
+        elapsed = round(time.perf_counter() - self.album.started, 3)
+        self.config.sink.report(Finding(check, self.level, path, tag, severity, message, elapsed))
+        if fix is not None and self.config.fix:
+            for track in self.album.tracks:
+                self.album.fixes.setdefault(track, set()).add(fix)
+
     def _check_all_same(self, tag):
         """Check and generate messages but don't print them
 
@@ -270,8 +2438,8 @@ class ValidatorBase(object):
         multiple = False
         msgs = []
 
-        temp = self.get_tag(tag, placeholder=True)
-        tags = set(temp)
+        tags, missing = self._get_tag_summary(tag)
+        tags = set(tags)
         if None in tags:
             tags.remove(None)
             if len(tags) == 0:
@@ -279,8 +2447,8 @@ class ValidatorBase(object):
                 msgs.append("missing from all items")
             else:
                 code = Missing.SOME
-                msgs.append("missing from {}/{} items".format(temp.count(None),
-                                                             len(temp)))
+                msgs.append("missing from {}/{} items".format(missing,
+                                                             self.span[1] - self.span[0]))
         if len(tags) > 1:
             multiple = True
             msgs.append("multiple values: {}".format(tags))
@@ -303,15 +2471,20 @@ class ValidatorBase(object):
                 continue
 
             if good is None:
-                print("{} tag detected - remove them".format(tagname))
+                self.report("tag_map", "{} tag detected - remove them".format(tagname), tagname,
+                            fix=("delete", tagname))
                 continue
 
+            # Tracks that already have the good tag just have the bad one removed
             rep = bad.sub(good, tagname) if regex else good
-            if self.get_tag(rep):
-                print("{} tag detected, remove them ({} tag already exists)".format(tagname, rep))
+            if None not in self.get_tag(rep, placeholder=True):
+                self.report("tag_map", "{} tag detected, remove them ({} tag already exists)".format(tagname, rep), tagname,
+                            fix=("rename", tagname, rep))
             else:
-                print("{} tag detected - use {} tags instead".format(tagname, rep))
+                self.report("tag_map", "{} tag detected - use {} tags instead".format(tagname, rep), tagname,
+                            fix=("rename", tagname, rep))
 
+    @PROFILER.profiled
     def validate_tag_contents(self):
         """Validate all tags, not the just the expected ones"""
 
@@ -327,21 +2500,22 @@ class ValidatorBase(object):
             self.process_tagmap(tagname)
 
             # Check for extra/only whitespace in tags
-            # TODO: taglib will not report zero-length tags - look into this
             stripped = tag.strip()
             if tag != stripped:
-                print("{} tag '{}' has extra whitespace in it".format(tagname, tag))
+                self.report("tag_whitespace", "{} tag '{}' has extra whitespace in it".format(tagname, tag), tagname,
+                            fix=("strip", tagname))
                 continue
             elif stripped == "":
-                print("{} tag is blank - delete it".format(tagname))
+                self.report("tag_blank", "{} tag is blank - delete it".format(tagname), tagname,
+                            fix=("delete_blank", tagname))
                 continue
 
             # Validate date-related tags are correctly formatted
             if tagname in DATE_TAGS:
                 if Date.parse(tag) is None:
-                    print("{} tag value '{}' is incorrectly formatted and "
-                          "couldn't be parsed (should be 'yyyy[-mm[-dd]]')"
-                          "".format(tagname, tag))
+                    self.report("date_format", "{} tag value '{}' is incorrectly formatted and "
+                                "couldn't be parsed (should be 'yyyy[-mm[-dd]]')"
+                                "".format(tagname, tag), tagname)
                 continue
 
     def validate_all_same(self, tag):
@@ -358,10 +2532,11 @@ class ValidatorBase(object):
         if code is not Missing.NONE or multiple:
             if self.level is Level.track:
                 # Track can't have multiple values
-                print("Problem with tag {}: missing".format(tag))
+                self.report("tag_consistency", "Problem with tag {}: missing".format(tag), tag)
             else:
-                print("Problem with tag {}: {}".format(tag, ", ".join(msgs)))
+                self.report("tag_consistency", "Problem with tag {}: {}".format(tag, ", ".join(msgs)), tag)
 
+    @PROFILER.profiled
     def validate_number_metadata(self):
         # Check for invalid [type]TOTAL metadata
         if self.level is Level.album:
@@ -382,11 +2557,11 @@ class ValidatorBase(object):
             try:
                 total = int(temp)
             except (ValueError, TypeError):
-                print("Problem with {} tag (non-numeric)".format(total_tag))
+                self.report("total", "Problem with {} tag (non-numeric)".format(total_tag), total_tag)
             else:
                 if total != len(self.children):
-                    print("Problem with {0} tag (found {2} {1}s, {0}={3})"
-                          "".format(total_tag, tag, len(self.children), total))
+                    self.report("total", "Problem with {0} tag (found {2} {1}s, {0}={3})"
+                                "".format(total_tag, tag, len(self.children), total), total_tag)
 
         # Check [type] sort order
         numbers = self.get_tag(number_tag)
@@ -394,32 +2569,57 @@ class ValidatorBase(object):
             try:
                 numbers = [int(x) for x in numbers]
             except (ValueError, TypeError):
-                print("WARNING: Not checking {} sort order ({} metadata is non-numeric)"
-                      "".format(tag, number_tag))
+                self.report("sort_order", "WARNING: Not checking {} sort order ({} metadata is non-numeric)"
+                            "".format(tag, number_tag), number_tag, Severity.warning)
             else:
                 if sorted(numbers) != numbers:
-                    print("{}s do not sort properly according to the {} metadata"
-                          "".format(tag.title(), number_tag))
+                    self.report("sort_order", "{}s do not sort properly according to the {} metadata"
+                                "".format(tag.title(), number_tag), number_tag)
 
+    @PROFILER.profiled
     def validate_metadata_structure(self):
         for tag in self.REQUIRED_TAGS:
             self.validate_all_same(tag)
 
+    @PROFILER.profiled
     def validate_replaygain(self):
         # To fix replaygain: `metaflac --add-replay-gain <all files from disc>`
         for tag in self.REPLAYGAIN_TAGS:
             self.validate_all_same(tag)
 
+    def compare_replaygain(self, kind, gain, peak):
+        """Compare the REPLAYGAIN_<kind>_GAIN/PEAK tags to values from the audio
+
+        Either value can be None to not check it
+        """
+        tagname = "REPLAYGAIN_{}_GAIN".format(kind)
+        tag = self.get_valid_tag(tagname)
+        m = REPLAYGAIN_GAIN_REGEX.match(tag or "")
+        if gain is not None and m and abs(float(m.group(1)) - gain) > GAIN_TOLERANCE:
+            self.report("replaygain_audio", "{} is '{}' but the audio needs {:+.2f} dB".format(tagname, tag, gain), tagname)
+
+        tagname = "REPLAYGAIN_{}_PEAK".format(kind)
+        tag = self.get_valid_tag(tagname)
+        try:
+            value = float(tag)
+        except (TypeError, ValueError):
+            # Reported by validate_replaygain
+            value = None
+        if peak is not None and value is not None and abs(value - peak) > PEAK_TOLERANCE:
+            self.report("replaygain_audio", "{} is '{}' but the peak of the audio is {:.6f}".format(tagname, tag, peak), tagname)
+
+    @PROFILER.profiled
     def validate_name(self):
         if self.name is None:
             return
 
         if not compare_names(self.name, self.name):
-            print("Invalid characters detected in the {} name: '{}'".format(self.filetype, self.name))
+            self.report("name_characters", "Invalid characters detected in the {} name: '{}'".format(self.filetype, self.name))
 
-        m = self.NAME_REGEX.match(self.name)
+        with PROFILER.timed("{}.NAME_REGEX".format(self.level)):
+            m = self.NAME_REGEX.match(self.name)
         if not m:
-            print("Incorrect {} {} name - correct format is '{}'".format(self.level, self.filetype, readable_regex(self.NAME_REGEX)))
+            self.report("name_format", "Incorrect {} {} name - correct format is '{}'".format(self.level, self.filetype, readable_regex(self.NAME_REGEX)))
             return
 
         metadata = {k: v for k, v in m.groupdict().items() if v is not None}
@@ -434,17 +2634,17 @@ class ValidatorBase(object):
                 tag = self.get_valid_tag(tagname)
 
             if tag is None:
-                print("Unable to validate {} against {} name (see above)".format(tagname, self.filetype))
+                self.report("name_tag", "Unable to validate {} against {} name (see above)".format(tagname, self.filetype), tagname, Severity.warning)
                 continue
 
             if not compare_names(tag, name, tagname):
-                print("Mismatch in tag {}: {}='{}', tag='{}'".format(tagname, self.filetype, name, tag))
+                self.report("name_tag", "Mismatch in tag {}: {}='{}', tag='{}'".format(tagname, self.filetype, name, tag), tagname)
 
         # Album-specific
         if self.level is Level.album:
             # Warn about missing OTHERINFO
             if "OTHERINFO" not in metadata:
-                print("No extra identifying information is included in the folder name")
+                self.report("name_otherinfo", "No extra identifying information is included in the folder name")
 
             # Don't require cue/log files for non-cd rips (assume CD)
             if metadata.get("MEDIA", "CD") != "CD":
@@ -455,32 +2655,29 @@ class ValidatorBase(object):
             albumartist_tag = self.get_valid_tag("ALBUMARTIST")
 
             if albumartist_tag is not None and albumartist is None:
-                print("No ALBUMARTIST found in the folder name but found in the tags")
+                self.report("name_albumartist", "No ALBUMARTIST found in the folder name but found in the tags", "ALBUMARTIST")
 
             if albumartist_tag is None and albumartist is not None:
-                print("ALBUMARTIST is in the folder name but is not in the tags")
+                self.report("name_albumartist", "ALBUMARTIST is in the folder name but is not in the tags", "ALBUMARTIST")
 
             if albumartist and albumartist.lower() in VARIOUS_ARTISTS:
-                print("An artist of '{}' should not be included in the folder name".format(albumartist))
+                self.report("name_albumartist", "An artist of '{}' should not be included in the folder name".format(albumartist), "ALBUMARTIST")
                 albumartist = None
 
             if albumartist is None and self.get_valid_tag("COMPILATION") != "1":
-                print("No/various ALBUMARTIST specified in the folder name but not tagged as a compilation")
+                self.report("name_albumartist", "No/various ALBUMARTIST specified in the folder name but not tagged as a compilation", "COMPILATION")
 
         # Track-specific
         elif self.level is Level.track:
             # Check if the artist should be in the filename
             discartist, missing, multiple = self.disc._get_tag_and_check("ARTIST")
             if discartist is not None and "ARTIST" in metadata:
-                print("ARTIST tags are all the same and therefore shouldn't be in the track name")
+                self.report("name_artist", "ARTIST tags are all the same and therefore shouldn't be in the track name", "ARTIST")
             elif multiple and "ARTIST" not in metadata:
-                print("Multiple ARTIST tags - the track should include the ARTIST")
+                self.report("name_artist", "Multiple ARTIST tags - the track should include the ARTIST", "ARTIST")
 
     def pre_validate(self):
-        if self.name is None:
-            print("Validating the only {}".format(self.level))
-        else:
-            print("Validating {}".format(self))
+        self.config.sink.start(self)
 
         self.validate_metadata_structure()
         if not self.config.no_replaygain:
@@ -501,32 +2698,27 @@ class ValidatorBase(object):
 
     def get_tag_list(self):
         """Get a list of all the different tags on this item"""
-        if self.level is Level.track:
-            return set(self.tags)
-        else:
-            return set(t for c in self.children for t in c.get_tag_list())
+        return self.album.tag_index.tags(*self.span)
+
+    def _report_duplicates(self, tag_name):
+        for _, tag in self.album.tag_index.find_duplicates(tag_name, *self.span):
+            self.report("duplicate_tags", "Found {} '{}' tags: {}".format(len(tag), tag_name, list(tag)), tag_name)
+
+    def _get_tag_summary(self, tag_name):
+        """Get the (distinct values, number missing) of a tag on this item"""
+        self._report_duplicates(tag_name)
+        return self.album.tag_index.summary(tag_name, *self.span)
 
     def get_tag(self, tag_name, placeholder=False):
-        if self.level is Level.track:
-            # Down at the track level, return the tag
-            if tag_name in self.tags:
-                tag = self.tags[tag_name]
-
-                # Check for duplicate tags
-                num_tags = len(tag)
-                if num_tags > 1:
-                    print("Found {} '{}' tags: {}".format(num_tags, tag_name, tag))
-                return [tag[0]]
-            if placeholder:
-                return [None]
-            else:
-                return []
-        else:
-            return list(t for c in self.children for t in c.get_tag(tag_name, placeholder))
+        self._report_duplicates(tag_name)
+        tags = self.album.tag_index.values(tag_name, *self.span)
+        if placeholder:
+            return tags
+        return [x for x in tags if x is not None]
 
     def get_valid_tag(self, tag_name):
         """Get a tag's valid if all children have the same one (otherwise None)"""
-        tags = set(self.get_tag(tag_name, placeholder=True))
+        tags, _ = self._get_tag_summary(tag_name)
         if len(tags) == 1 and None not in tags:
             return next(iter(tags))
         return None
@@ -567,10 +2759,11 @@ class Album(ValidatorBase):
     REQUIRED_TAGS = {"ALBUM", "DATE", "ORIGINALDATE", "ALBUMARTIST", "DISCTOTAL", "MEDIA"}
     _NAME_PATTERN = "^(?:(?P<ALBUMARTIST>.*?) - )?(?P<ALBUM>.*) \((?P<ORIGINALDATE>.*)\) \[(?P<MEDIA>.+?) ?- ?FLAC(?: ?- ?(?P<QUALITY>[^\]]*))?\](?: \{(?P<OTHERINFO>.*)\})?$"
 
-    def __init__(self, directory, config):
+    def __init__(self, directory, config, sink=None):
         super().__init__()
         # Keep a copy of the config - our changes shouldn't affect other Albums
-        self._config = argparse.Namespace(**vars(config), checked_tags=set())
+        self._config = argparse.Namespace(**vars(config), checked_tags=set(),
+                                          sink=sink or SINKS[config.format]())
         self.directory = os.path.abspath(directory)
 
         if not os.path.isdir(self.directory):
@@ -578,52 +2771,209 @@ class Album(ValidatorBase):
 
         self.parent_dir = os.path.dirname(self.directory)
         self.name = os.path.basename(self.directory)
-        self.discs = self._find_discs()
+        with PROFILER.timed("album._find_discs"):
+            self.discs = self._find_discs()
+        self._executor = None
+        self._tag_index = None
+        self.audio_md5s = {}  # The first track with each decoded audio MD5
+        self.fixes = {}  # track: {fixes for its tags}
+        self.started = time.perf_counter()
+
+        # Each item covers a contiguous span of the tracks in the tag index
+        start = 0
+        for disc in self.discs:
+            disc.span = (start, start + len(disc.tracks))
+            for i, track in enumerate(disc.tracks, start):
+                track.span = (i, i + 1)
+            start = disc.span[1]
+        self.span = (0, start)
+
+        self.NAME_REGEX = compile_name_regex(self._NAME_PATTERN,
+                                             "ALBUMARTIST" if self.config.no_albumartist else None)
 
-        if self.config.no_albumartist:
-            self.NAME_REGEX = re.compile(remove_optional_regex(self._NAME_PATTERN, "ALBUMARTIST"))
-        else:
-            self.NAME_REGEX = re.compile(self._NAME_PATTERN)
+    @property
+    def album(self):
+        return self
 
+    @property
+    def tracks(self):
+        return [t for d in self.discs for t in d.tracks]
+
+    @property
+    def tag_index(self):
+        if self._tag_index is None:
+            with PROFILER.timed("TagIndex"):
+                self._tag_index = TagIndex(self.tracks)
+        return self._tag_index
+
+    @PROFILER.profiled
     def validate_compilation(self):
         """Validate the relationship between ARTIST, ALBUMARTIST and COMPILATION"""
         # Validate compilation tag
         compilation, c_missing, _ = self._get_tag_and_check("COMPILATION")
         if not (c_missing is Missing.ALL or (c_missing is Missing.NONE and compilation == "1")):
-            print("Invalid COMPILATION tag: must all be set to '1' or unset")
+            self.report("compilation", "Invalid COMPILATION tag: must all be set to '1' or unset", "COMPILATION")
 
         # Blank ALBUMARTIST, same ARTIST
         albumartist, aa_missing, _ = self._get_tag_and_check("ALBUMARTIST")
         artist, a_missing, multiple_artists = self._get_tag_and_check("ARTIST")
         if aa_missing is Missing.ALL and artist is not None:
-            print("ALBUMARTIST tag should be set to '{}' (is unset but ARTIST tags are all the same)".format(artist))
+            self.report("compilation", "ALBUMARTIST tag should be set to '{}' (is unset but ARTIST tags are all the same)".format(artist), "ALBUMARTIST")
 
         # same ARTISTS, different than ALBUMARTIST
         if None not in (artist, albumartist) and artist != albumartist:
-            print("ALBUMARTIST is set to '{}' but all the ARTIST tags are '{}'".format(albumartist, artist))
+            self.report("compilation", "ALBUMARTIST is set to '{}' but all the ARTIST tags are '{}'".format(albumartist, artist), "ALBUMARTIST")
 
         # Different ARTISTs, not a compilation
         if (albumartist and albumartist.lower() in VARIOUS_ARTISTS) and compilation != "1":
-            print ("ALBUMARTIST is set to '{}' but COMPILATION is not set".format(albumartist))
+            self.report("compilation", "ALBUMARTIST is set to '{}' but COMPILATION is not set".format(albumartist), "COMPILATION",
+                        fix=("set", "COMPILATION", "1"))
 
         # Not a compilation, but different ARTISTS
         if compilation != "1" and multiple_artists:
-            print("COMPILATION is not set but there are multiple different ARTISTs tags")
+            self.report("compilation", "COMPILATION is not set but there are multiple different ARTISTs tags", "COMPILATION",
+                        fix=("set", "COMPILATION", "1"))
+
+    @PROFILER.profiled
+    def validate_duplicates(self):
+        """Find tracks in other albums of the library with the same audio
+
+        Uses the STREAMINFO MD5s so nothing has to be decoded
+        """
+        tracks = [t for d in self.discs for t in d.tracks
+                  if t.streaminfo is not None and any(t.streaminfo.md5)]
+        cache = open_cache(self.config.cache, self.config.cache_size)
+        with PROFILER.timed("update audio index"):
+            duplicates = cache.update_audio(self.directory, [
+                (t.path, t.streaminfo.md5, t.streaminfo.total_samples) for t in tracks
+            ])
+
+        # Report whole albums instead of each of their tracks
+        albums = collections.Counter(a for t in tracks for a in {a for a, _ in duplicates[t.path]})
+        whole = sorted(a for a, n in albums.items() if n == len(tracks))
+        for album in whole:
+            self.report("duplicate_audio", "All the tracks have the same audio as the ones in '{}'".format(album))
+        if whole:
+            return
 
+        for track in tracks:
+            for _, path in duplicates[track.path]:
+                self.report("duplicate_audio", "'{}' has the same audio as '{}'".format(
+                    os.path.relpath(track.path, self.directory), path))
+
+    @PROFILER.profiled
+    def validate_spellings(self):
+        """Find artist and label names that are spelled differently in other albums
+
+        Uses the index of the names in every album that was checked before with
+        --library
+        """
+        names = {(tag, x) for tag in SPELLING_TAGS for x in self.tag_index.values(tag, *self.span)
+                 if x and x.strip() and x.lower() not in VARIOUS_ARTISTS}
+        cache = open_cache(self.config.cache, self.config.cache_size)
+        with PROFILER.timed("update names index"):
+            spellings = cache.update_names(self.directory, sorted(names))
+
+        for (tag, value), others in sorted(spellings.items()):
+            albums = collections.OrderedDict()
+            for album, other in others:
+                albums.setdefault(other, []).append(album)
+            for other, albums in albums.items():
+                more = " (and {} other albums)".format(len(albums) - 1) if len(albums) > 1 else ""
+                self.report("spelling", "{} '{}' is spelled '{}' in '{}'{}".format(
+                    tag, value, other, albums[0], more), tag)
+
+    @PROFILER.profiled
     def validate_albumartist(self):
         albumartist = self.get_valid_tag("ALBUMARTIST")
         if albumartist and albumartist.lower() in VARIOUS_ARTISTS:
-            print("The ALBUMARTST tag is '{}' - for albums without a main "
-                  "artist it should be deleted instead".format(albumartist))
+            self.report("albumartist", "The ALBUMARTST tag is '{}' - for albums without a main "
+                        "artist it should be deleted instead".format(albumartist), "ALBUMARTIST")
 
     @validator
     def validate(self):
+        if self.config.checklevel is not Level.track:
+            # The tracks aren't validated themselves
+            for track in self.tracks:
+                if track.error is not None:
+                    track.report("flac_invalid", "Invalid FLAC file '{}': {}".format(
+                        os.path.relpath(track.path, self.directory), track.error))
         self.validate_compilation()
         self.validate_albumartist()
+        if self.config.find_duplicates and self.config.cache is not None:
+            self.validate_duplicates()
+            self.validate_spellings()
+
+    def pre_validate(self):
+        self.started = time.perf_counter()
+        # Start testing the files in the background while the tags are checked
+        self.start_integrity_checks()
+        super().pre_validate()
+
+    def post_validate(self):
+        try:
+            super().post_validate()
+            if self.fixes:
+                self.fix_tags()
+            self.config.sink.finish(self)
+        finally:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+                self._executor = None
+
+    @PROFILER.profiled
+    def fix_tags(self):
+        """Apply all the fixes for each track in one write (or show them with --dry-run)"""
+        for track, fixes in self.fixes.items():
+            try:
+                old, new = rewrite_tags(track.path, fixes, self.config.dry_run)
+            except (OSError, ValueError) as e:
+                track.report("fix", "Failed to fix the tags: {}".format(e))
+                continue
+            if old == new:
+                continue
+            diff = [x for x in difflib.unified_diff(old, new, n=0, lineterm="")
+                    if not x.startswith(("---", "+++", "@@"))]
+            track.report("fix", "{} the tags of '{}':\n{}".format(
+                "Would change" if self.config.dry_run else "Changed",
+                os.path.relpath(track.path, self.directory), "\n".join(diff)), severity=Severity.info)
+        self.fixes = {}
+
+    def start_integrity_checks(self):
+        """Submit the integrity checks of every track to a pool of workers
+
+        The results are collected in order as each track is validated
+        """
+        if not (self.config.checklevel is Level.track or
+                (self.config.checklevel is Level.disc and
+                 (self.config.verify_replaygain or self.config.verify_log))):
+            return
+
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.config.jobs)
+        scheduler = IOScheduler(self.config.io_concurrency_per_device)
+        batches = min(self.config.jobs, scheduler.limit or self.config.jobs)
+        for disc in self.discs:
+            if scheduler.limit is None:
+                devices = {None: disc.tracks}
+            else:
+                # Read the files on each device in the order they are on the disk
+                locations = {t.path: disk_location(t.path) for t in disc.tracks}
+                devices = collections.defaultdict(list)
+                for track in sorted(disc.tracks, key=lambda t: locations[t.path][1]):
+                    devices[locations[track.path][0]].append(track)
+
+            # Split the tracks into a batch per worker so flac isn't started for every track
+            for device, tracks in devices.items():
+                size = math.ceil(len(tracks) / batches)
+                for start in range(0, len(tracks), size):
+                    batch = scheduler.submit(self._executor, device, disc.check_integrity,
+                                             tracks[start:start + size])
+                    for i, track in enumerate(tracks[start:start + size]):
+                        track.integrity = (batch, i)
 
     def _find_discs(self):
         ret = []
-        for dirpath, dirs, files in os.walk(self.directory):
+        for dirpath, _, files in walk_dirs(self.directory):
             if not any(x for x in files if has_ext(x, "flac")):
                 continue
 
@@ -642,6 +2992,7 @@ class Disc(ValidatorBase):
     def __init__(self, album, directory, files):
         super().__init__()
         self.album = album
+        self.span = None
         self.directory = directory
 
         # Sort the files by name to later validate they sort correctly by tracknumber
@@ -657,99 +3008,714 @@ class Disc(ValidatorBase):
     def validate(self):
         # Check album art is present
         if not files_by_regex(self.files, COVER_REGEX):
-            print("No cover art found")
+            self.report("cover", "No cover art found")
 
         # Check cue and log files are present
         if not self.album.config.no_cue_log:
             for x in ("cue", "log"):
                 f = files_by_ext(self.files, x)
                 if not f:
-                    print("No *.{} file found".format(x))
+                    self.report("cue_log", "No *.{} file found".format(x))
                 elif len(f) > 1:
-                    print("Multiple *.{} files found".format(x))
+                    self.report("cue_log", "Multiple *.{} files found".format(x))
 
         # Check if m3u files are present
         for x in ("m3u", "m3u8"):
             if files_by_ext(self.files, x):
-                print("*.{} file detected - delete it".format(x))
+                self.report("m3u", "*.{} file detected - delete it".format(x))
+
+        if self.config.verify_replaygain and not self.config.no_replaygain:
+            self.verify_replaygain()
+
+        if self.config.verify_log and files_by_ext(self.files, "log"):
+            self.verify_log()
+
+    @PROFILER.profiled
+    def verify_log(self):
+        """Compare the CRC32 and AccurateRip checksums in the rip logs to the audio"""
+        logs = {}
+        for log in files_by_ext(self.files, "log"):
+            for number, checksums in parse_rip_log(os.path.join(self.directory, log)).items():
+                logs.setdefault(number, []).append(checksums)
+        if not logs:
+            self.report("log_checksums", "Unable to verify the tracks - no track checksums found in the log", severity=Severity.warning)
+            return
+
+        # AccurateRip treats the first and last audio tracks differently
+        numbers = set(logs)
+        for cue in files_by_ext(self.files, "cue"):
+            numbers = set(parse_cue_tracks(os.path.join(self.directory, cue))) or numbers
+        first, last = min(numbers), max(numbers)
+
+        for track in self.tracks:
+            audio = track.get_integrity().audio
+            if audio is None:
+                # Couldn't be decoded (reported for the track)
+                continue
+            if audio["accuraterip"] is None:
+                self.report("log_checksums", "Unable to verify '{}' against the log - it isn't CD audio".format(track.name), severity=Severity.warning)
+                continue
+            try:
+                number = int(track.get_valid_tag("TRACKNUMBER").split("/")[0])
+            except (AttributeError, ValueError):
+                # Reported by the other checks
+                continue
+            if number not in logs:
+                self.report("log_checksums", "Track {} isn't in the log".format(number))
+                continue
+
+            crc32 = audio["accuraterip"]["crc32"]
+            expected = [x["crc32"] for x in logs[number] if x["crc32"] is not None]
+            if expected and crc32 not in expected:
+                self.report("log_checksums", "Track {}: the CRC32 of the audio is {:08X} but the log has {:08X}".format(number, crc32, expected[0]))
+
+            checksums = accuraterip_checksums(audio["accuraterip"], number == first, number == last)
+            for version, checksum in enumerate(checksums, 1):
+                expected = [x["accuraterip"][version] for x in logs[number] if version in x["accuraterip"]]
+                if expected and checksum not in expected:
+                    self.report("log_checksums", "Track {}: the AccurateRip v{} checksum of the audio is {:08X} but the log has {:08X}"
+                                "".format(number, version, checksum, expected[0]))
+
+    @PROFILER.profiled
+    def verify_replaygain(self):
+        """Compare the album ReplayGain tags to the audio of all the tracks"""
+        audio = [t.get_integrity().audio for t in self.tracks]
+        if any(x is None for x in audio):
+            # The tracks couldn't be decoded (reported for each track)
+            return
+        if any(x["replaygain"] is None for x in audio):
+            self.report("replaygain_audio", "Unable to verify the ReplayGain - only {} Hz audio with 1 or 2 channels is supported"
+                        "".format(" and ".join(str(x) for x in sorted(REPLAYGAIN_FILTERS))), severity=Severity.warning)
+            return
+
+        histogram = sum(decode_histogram(x["replaygain"]["histogram"]) for x in audio)
+        self.compare_replaygain("ALBUM", replaygain(histogram), max(x["peak"] for x in audio))
 
     def _find_tracks(self):
         return [Track(self, os.path.join(self.directory, x))
                 for x in self.files if has_ext(x, "flac")]
 
+    def check_integrity(self, tracks):
+        """Read the metadata and test some of the tracks for corruption
+
+        The files that need to be tested by flac are batched into as few calls
+        as possible. Doesn't print anything so it can be safely run in a worker
+        thread.
+
+        returns an IntegrityResult for each track. verified is None if the file
+        wasn't tested and metadata is the OSError or ValueError if it couldn't
+        be read.
+        """
+        config = self.config
+        results = []
+        for track in tracks:
+            try:
+                with PROFILER.timed("FlacMetadata"):
+                    metadata = FlacMetadata(track.path)
+            except (OSError, ValueError) as e:
+                results.append(IntegrityResult(e, None, [], None))
+                continue
+
+            frame_errors = []
+            if config.quick_verify and not config.no_flactest:
+                with PROFILER.timed("verify_frames"):
+                    frame_errors = verify_frames(track.path, metadata)
+            results.append(IntegrityResult(metadata, None, frame_errors, None))
+
+        if config.no_flactest or config.quick_verify or not (EXTERNALS["flac"] or np is not None):
+            return results
+
+        consumers = pcm_consumers(config)
+        names = {x.name for x in consumers}
+        cache = None
+        keys = {}
+        if config.cache is not None:
+            cache = open_cache(config.cache, config.cache_size)
+            for i, (track, result) in enumerate(zip(tracks, results)):
+                if isinstance(result.metadata, (OSError, ValueError)):
+                    continue
+                keys[track.path] = cache.file_key(track.path, result.metadata.streaminfo.md5)
+                cached = cache.get(track.path, keys[track.path])
+                # Results from `flac --test` (or other options) may not have the audio analysis
+                if cached is not None and (not config.decode or not cached[0] or
+                                           names <= (cached[1] or {}).keys()):
+                    # Only use the parts of the analysis that were asked for this time
+                    audio = None
+                    if config.decode and cached[1] is not None:
+                        audio = {k: v for k, v in cached[1].items() if k in names}
+                    results[i] = result._replace(verified=cached[0], audio=audio)
+
+        untested = [(t, r.metadata) for t, r in zip(tracks, results)
+                    if r.verified is None and not isinstance(r.metadata, (OSError, ValueError))]
+        tested = {}
+        if config.decode:
+            for track, metadata in untested:
+                tested[track.path] = analyse_audio(track.path, metadata, consumers)
+        elif not EXTERNALS["flac"]:
+            # The built-in decoder checks the MD5 (or just the frames without one)
+            for track, metadata in untested:
+                tested[track.path] = (analyse_audio(track.path, metadata, (MD5Consumer,))[0], None)
+        else:
+            # Verify flac MD5 information (can only check the frames without one)
+            for has_md5 in (True, False):
+                paths = [t.path for t, m in untested if m.has_md5 is has_md5]
+                if paths:
+                    for path, verified in flac_test(paths, warnings_as_errors=has_md5).items():
+                        tested[path] = (verified, None)
+
+        for i, track in enumerate(tracks):
+            if track.path in tested:
+                verified, audio = tested[track.path]
+                results[i] = results[i]._replace(verified=verified, audio=audio)
+                if cache is not None:
+                    cache.put(track.path, keys[track.path], verified, audio)
+
+        return results
+
 class Track(ValidatorBase):
 
     REQUIRED_TAGS = {"ARTIST", "TRACKNUMBER", "TITLE"}
     REPLAYGAIN_TAGS = {"REPLAYGAIN_TRACK_GAIN", "REPLAYGAIN_TRACK_PEAK"}
     _NAME_PATTERN = "^(?P<TRACKNUMBER>[^ ]*) - (?:(?P<ARTIST>.*) - )?(?P<TITLE>.*).flac$"
 
+    # There can be a lot of tracks - keep them small
+    __slots__ = ("disc", "span", "path", "name", "integrity", "_tags", "_streaminfo", "_error")
+
     def __init__(self, disc, path):
         super().__init__()
         self.disc = disc
+        self.span = None
         self.path = path
         self.name = os.path.basename(path)
-        self.song = taglib.File(path)
-        self.tags = self.song.tags
+        self.integrity = None
+        self._tags = None
+        self._streaminfo = None
+        self._error = None
+
+    @property
+    def NAME_REGEX(self):
+        return compile_name_regex(self._NAME_PATTERN,
+                                  "ARTIST" if self.config.no_trackartist else None)
+
+    @property
+    def album(self):
+        return self.disc.album
+
+    @property
+    def tags(self):
+        """The tags of the track
+
+        They're read the first time they're needed
+        """
+        if self._tags is None:
+            self._read_metadata()
+        return self._tags
+
+    @property
+    def streaminfo(self):
+        """The StreamInfo of the track (None if the file is invalid)"""
+        if self._tags is None:
+            self._read_metadata()
+        return self._streaminfo
 
-        if self.config.no_trackartist:
-            self.NAME_REGEX = re.compile(remove_optional_regex(self._NAME_PATTERN, "ARTIST"))
+    @property
+    def error(self):
+        """The OSError or ValueError if the file couldn't be read (otherwise None)"""
+        if self._tags is None:
+            self._read_metadata()
+        return self._error
+
+    def _read_metadata(self):
+        try:
+            with PROFILER.timed("read tags"):
+                metadata = FlacMetadata(self.path)
+        except (OSError, ValueError) as e:
+            # Reported as an invalid file (and left out of the tag checks)
+            self._tags = types.MappingProxyType({})
+            self._error = e
+            return
+        self._tags = types.MappingProxyType({k: tuple(v) for k, v in metadata.tags.items()})
+        self._streaminfo = metadata.streaminfo
+
+    def pre_validate(self):
+        if self.error is None:
+            super().pre_validate()
         else:
-            self.NAME_REGEX = re.compile(self._NAME_PATTERN)
+            # Don't report all the tags as missing
+            self.config.sink.start(self)
 
     @validator
     def validate(self):
+        if self.error is not None:
+            self.report("flac_invalid", "Invalid FLAC file: {}".format(self.error))
+            return
+
         # Ensure the total path length is ok
         rel_path = os.path.relpath(self.path, start=self.disc.album.parent_dir)
         pathlen = len(rel_path)
         if pathlen > MAX_PATH_LENGTH:
-            print("The path '{}' is too long ({} > {})".format(rel_path, pathlen, MAX_PATH_LENGTH))
+            self.report("path_length", "The path '{}' is too long ({} > {})".format(rel_path, pathlen, MAX_PATH_LENGTH))
 
         # Don't allow various artists in the ARTIST tag
         artist = self.get_valid_tag("ARTIST")
         if artist and artist.lower() in VARIOUS_ARTISTS:
-            print ("Invalid ARTIST: can't be '{}' (use ALBUMARTIST instead)".format(artist))
+            self.report("artist", "Invalid ARTIST: can't be '{}' (use ALBUMARTIST instead)".format(artist), "ARTIST")
 
-        if not self.config.no_flactest and EXTERNALS["flac"]:
-            # Verify flac MD5 information
-            if quiet_call(("flac", "--test", "--warnings-as-errors", self.path)) != 0:
-                print("Failed to verify FLAC file - it may be corrupt or not have an MD5 set")
+        metadata, verified, frame_errors, audio = self.get_integrity()
 
-        if EXTERNALS["metaflac"]:
-            # Make sure there's no embedded album art
-            if quiet_call(("metaflac", "--export-picture-to=-", self.path)) == 0:
-                print("Album art is embedded - remove it and provide a high-res image file instead.")
+        if isinstance(metadata, (OSError, ValueError)):
+            self.report("flac_invalid", "Invalid FLAC file: {}".format(metadata))
+            return
 
+        if not metadata.has_md5:
+            self.report("flac_md5", "No MD5 of the audio is set in the STREAMINFO - re-encode the file to add one")
 
-def main():
-    if sys.version_info < (3, 3):
-        print("check-flac requires Python 3.3+ to run")
-        return 1
+        if verified is False:
+            self.report("flac_verify", "Failed to verify FLAC file - it may be corrupt")
 
-    # Warn for missing executables
-    for k, v in EXTERNALS.items():
-        if not v:
-            print("WARNING: couldn't find the '{}' executable - some features will be unavailable".format(k))
+        for error in frame_errors:
+            self.report("flac_frames", "Frame check failed: {}".format(error))
+
+        if metadata.has_picture:
+            self.report("embedded_art", "Album art is embedded - remove it and provide a high-res image file instead.")
+
+        if audio is not None:
+            self.validate_audio(audio)
+
+    @PROFILER.profiled
+    def validate_audio(self, audio):
+        """Validate the track against the analysis of its decoded audio"""
+        if not self.config.no_replaygain:
+            gain = audio.get("replaygain") or {}
+            self.compare_replaygain("TRACK", gain.get("gain"), audio["peak"])
+
+        other = self.album.audio_md5s.setdefault(audio["md5"], self)
+        if other is not self:
+            self.report("duplicate_audio", "The audio is identical to '{}'".format(os.path.relpath(other.path, self.album.directory)))
+
+    def get_integrity(self):
+        """Get the result of the integrity check started by the album (or run it now)"""
+        if self.integrity is None:
+            return self.check_integrity()
+        batch, i = self.integrity
+        with PROFILER.timed("track.wait_for_integrity"):
+            return batch.result()[i]
+
+    def check_integrity(self):
+        """Read the metadata and test the file for corruption
+
+        See Disc.check_integrity
+        """
+        return self.disc.check_integrity([self])[0]
+
+
+def validate_album(directory, config):
+    """Validate an album
+
+    returns (everything that it printed, profiler events)
+    """
+    PROFILER.enabled = config.profile or bool(config.profile_trace)
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        Album(directory, config).validate()
+    return output.getvalue(), PROFILER.pop_events()
+
+
+def resume_album(item, config):
+    """Validate an album unless it hasn't changed since it was recorded in the journal
+
+    item is (the album directory, its journal entry or None)
+    returns (what was printed, profiler events, the new journal entry or None)
+    """
+    directory, entry = item
+    directory = os.path.abspath(directory)
+    fingerprint = album_fingerprint(directory)
+    options = json.dumps({k: v for k, v in vars(config).items() if k not in RUN_OPTIONS},
+                         sort_keys=True, default=str)
+    if entry is not None and entry.get("fingerprint") == fingerprint and entry.get("options") == options:
+        return entry["output"], [], None
 
-    parser = argparse.ArgumentParser()
-    parser.add_argument("albums", nargs="+", help="The album(s) to check")
+    output, events = validate_album(directory, config)
+    return output, events, {"album": directory, "fingerprint": fingerprint,
+                            "options": options, "output": output}
+
+
+def bounded_map(executor, func, items, limit):
+    """Like executor.map but only submits up to `limit` items at once
+
+    Items are consumed lazily and results are yielded in order
+    """
+    pending = collections.deque()
+    for item in items:
+        pending.append(executor.submit(func, item))
+        if len(pending) >= limit:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def parse_args(argv=None, parser_class=argparse.ArgumentParser):
+    """Parse the command line arguments
+
+    returns (config, iterable of album directories)
+    """
+    parser = parser_class()
+    parser.add_argument("albums", nargs="*", help="The album(s) to check")
+    parser.add_argument("--library", action="append", default=[], help="Find and check all the albums in a directory (can be used multiple times). Also reports tracks with the same audio and artist and label names spelled differently across the library (unless --no-cache is used)")
+    parser.add_argument("--watch", action="store", metavar="DIR", help="Keep running and check the albums in a directory whenever they change")
+    parser.add_argument("--settle-time", action="store", type=float, default=5, metavar="SECONDS", help="How long an album has to be left unchanged before --watch checks it (default: %(default)s)")
+    parser.add_argument("--serve", action="store", metavar="SOCKET", help="Keep running and check albums sent by --connect to a Unix socket (using the options given to --serve)")
+    parser.add_argument("--connect", action="store", metavar="SOCKET", help="Check the albums with a server started with --serve instead")
+    parser.add_argument("--format", action="store", choices=tuple(SINKS), default="text", help="How to print the findings: text, or jsonl for a JSON object per line with the check, level, path, tag, severity, message, and elapsed time of each finding (default: %(default)s)")
+    parser.add_argument("--resume", action="store", metavar="JOURNAL", help="Record the results of each album in a journal file and don't check the albums in it again if they haven't changed (to continue an interrupted run)")
+    parser.add_argument("--fix", action="store_true", help="Fix the tags that have an obvious fix (renaming or removing tags, stripping whitespace, removing blank values, and setting COMPILATION) with one write per file")
+    parser.add_argument("--dry-run", action="store_true", help="With --fix, show the changes to the tags instead of making them")
     parser.add_argument("--checklevel", action="store", type=str, choices=tuple(Level.values()), default=str(Level.track), help="The level to check down to (default: %(default)s)")
     parser.add_argument("--no-replaygain", action="store_true", help="Don't check for any replaygain tags")
     parser.add_argument("--no-flactest", action="store_true", help="Don't test flac files for corruption/errors (can be slow)")
     parser.add_argument("--no-albumartist", action="store_true", help="Assume the album artist is NOT in the foldername (default is to detect this automatically, only enable if you have issues)")
     parser.add_argument("--no-trackartist", action="store_true", help="Assume the artist is NOT in track filenames (default is to detect this automatically, only enable if you have issues)")
+    parser.add_argument("--quick-verify", action="store_true", help="Only check the CRCs of the frames instead of fully decoding the files (much faster, but doesn't check the MD5)")
+    parser.add_argument("--decode", action="store_true", help="Decode each track once instead of just testing it and also check the audio: REPLAYGAIN_TRACK_PEAK and tracks with identical audio")
+    parser.add_argument("--verify-replaygain", action="store_true", help="Calculate the ReplayGain of the decoded audio and check the tags match it (implies --decode, requires numpy)")
+    parser.add_argument("--verify-log", action="store_true", help="Check the audio matches the CRC32 and AccurateRip checksums of each track in the EAC/XLD logs (implies --decode, requires numpy)")
+    parser.add_argument("--jobs", "-j", action="store", type=int, default=os.cpu_count() or 1, help="The number of tracks to test for corruption/errors at the same time (default: %(default)s)")
+    parser.add_argument("--io-concurrency-per-device", action="store", type=int, metavar="N", help="The number of batches of tracks to read from each disk at the same time in each album process, in the order they are stored on the disk (useful for spinning disks and network mounts) (default: unlimited)")
+    parser.add_argument("--album-jobs", action="store", type=int, default=1, help="The number of albums to check at the same time in separate processes (each one uses up to --jobs threads) (default: %(default)s)")
+    parser.add_argument("--no-cache", action="store_true", help="Don't use or update the cache of verification results (or the indexes used to find duplicates and different spellings)")
+    parser.add_argument("--rebuild-cache", action="store_true", help="Discard all cached verification results before checking (the indexes used to find duplicates and different spellings are kept)")
+    parser.add_argument("--cache-size", action="store", type=int, default=64, help="The maximum size of the cached verification results in MB (default: %(default)s)")
+    parser.add_argument("--profile", action="store_true", help="Print a summary of how long each check took")
+    parser.add_argument("--profile-trace", action="store", metavar="FILE", help="Write how long each check took to a file in the Chrome trace event format")
     parser.add_argument("--no-cue-log", action="store_true", help="Don't look for any *.cue or *.log files (this is the default for non-CD media)")
 
-    config = parser.parse_args()
-    albums = config.albums
+    config = parser.parse_args(argv)
+    if not config.albums and not config.library and config.watch is None and config.serve is None:
+        parser.error("no albums, --library, --watch, or --serve specified")
+    if sum(x is not None for x in (config.watch, config.serve, config.connect)) > 1:
+        parser.error("only one of --watch, --serve, and --connect can be used")
+    if (config.serve or config.connect) and not hasattr(socketserver, "ThreadingUnixStreamServer"):
+        parser.error("--serve and --connect require Unix sockets")
+    if config.watch is not None and not os.path.isdir(config.watch):
+        parser.error("--watch directory '{}' does not exist".format(config.watch))
+
+    # Albums in libraries are checked as they're found
+    albums = itertools.chain(config.albums, *(find_albums(x) for x in config.library))
 
     # Massage the config a bit
+    # Also finds different spellings
+    config.find_duplicates = bool(config.library)
     delattr(config, "albums")
+    delattr(config, "library")
     config.checklevel = Level(config.checklevel)
+    if config.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    if config.album_jobs < 1:
+        parser.error("--album-jobs must be at least 1")
+    for option in ("verify_replaygain", "verify_log"):
+        if getattr(config, option):
+            if np is None:
+                parser.error("--{} requires numpy".format(option.replace("_", "-")))
+            config.decode = True
+    if config.dry_run and not config.fix:
+        parser.error("--dry-run requires --fix")
+    if config.decode and config.quick_verify:
+        parser.error("--decode can't be used with --quick-verify")
+    if config.io_concurrency_per_device is not None and config.io_concurrency_per_device < 1:
+        parser.error("--io-concurrency-per-device must be at least 1")
+
+    config.cache = None if config.no_cache else CACHE_FILE
+    config.cache_size *= 1024 * 1024
+    delattr(config, "no_cache")
+
+    return config, albums
+
+
+Report = collections.namedtuple("Report", ("album", "findings"))
 
-    for album in albums:
-        Album(album, config).validate()
+
+class _OptionsParser(argparse.ArgumentParser):
+    """Raises a ValueError for invalid options instead of exiting"""
+
+    def error(self, message):
+        raise ValueError(message)
+
+
+def make_config(**options):
+    """Get the config for options given like the command line options
+
+    For example: make_config(decode=True, checklevel="disc", no_cache=True)
+    """
+    argv = []
+    for name, value in options.items():
+        flag = "--{}".format(name.replace("_", "-"))
+        if value is True:
+            argv.append(flag)
+        elif value is not None and value is not False:
+            argv.extend((flag, str(value)))
+    config, _ = parse_args([os.curdir] + argv, parser_class=_OptionsParser)
+    return config
+
+
+def check_album(directory, **options):
+    """Check an album and return the findings instead of printing them
+
+    options are the same as the command line options (see make_config).
+    Albums can be checked from multiple threads at the same time.
+
+    returns a Report
+    """
+    return _check_album(directory, make_config(**options))
+
+
+def _check_album(directory, config):
+    sink = ListSink()
+    album = Album(directory, config, sink)
+    album.validate()
+    return Report(album.directory, sink.findings)
+
+
+def check_albums(directories, **options):
+    """Check albums and return the findings instead of printing them
+
+    Up to album_jobs albums are checked at the same time in threads. See
+    check_album for the options.
+
+    returns an iterator of a Report for each album (in order)
+    """
+    # Invalid options are reported now rather than when the results are used
+    return _check_albums(directories, make_config(**options))
+
+
+def _check_albums(directories, config):
+    func = functools.partial(_check_album, config=config)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=config.album_jobs) as executor:
+        yield from bounded_map(executor, func, directories, config.album_jobs * 2)
+
+
+def log(config, message):
+    """Print a status message (to stderr if the findings are meant to be parsed)"""
+    print(message, file=sys.stdout if config.format == "text" else sys.stderr)
+
+
+def log_album_error(item, config, func):
+    """Call func (validate_album or resume_album) but log an error instead of raising it
+
+    returns what func returns or (the error if it's printed with the findings,
+    no profiler events, no journal entry) if it failed
+    """
+    try:
+        return func(item)
+    except Exception as e:
+        directory = item[0] if isinstance(item, tuple) else item
+        message = "ERROR: couldn't check '{}' ({})".format(directory, e)
+        if config.format == "text":
+            # Printed in order with the output of the other albums
+            return message + "\n", [], None
+        log(config, message)
+        return "", [], None
+
+
+def validate_albums(albums, config, journal=None, keep_going=False):
+    """Validate albums and print the results
+
+    With a journal, the results of albums that haven't changed since they
+    were recorded in it are printed again instead of checking them. With
+    keep_going, errors are logged and the other albums are still checked.
+    """
+    if config.album_jobs == 1 and journal is None and not keep_going:
+        for album in albums:
+            Album(album, config).validate()
+            sys.stdout.flush()
+        return
+
+    if journal is None:
+        func = functools.partial(validate_album, config=config)
+    else:
+        func = functools.partial(resume_album, config=config)
+        albums = ((x, journal.get(x)) for x in albums)
+    if keep_going:
+        func = functools.partial(log_album_error, config=config, func=func)
+
+    with contextlib.ExitStack() as stack:
+        if config.album_jobs == 1:
+            results = map(func, albums)
+        else:
+            # Validate albums in other processes and print each one's output
+            # all at once (and in order) so they don't get mixed together
+            executor = stack.enter_context(
+                concurrent.futures.ProcessPoolExecutor(max_workers=config.album_jobs))
+            results = bounded_map(executor, func, albums, config.album_jobs * 2)
+
+        for output, events, *entry in results:
+            sys.stdout.write(output)
+            sys.stdout.flush()
+            PROFILER.extend(events)
+            if journal is not None and entry[0] is not None:
+                journal.record(entry[0])
+
+
+def serve(path, config):
+    """Check albums for clients connecting to a Unix socket until interrupted
+
+    This avoids the start up time of each run and keeps the worker processes
+    (and their caches) around between requests. The protocol is JSON lines:
+    clients send {"album": directory} for each album and shut down their side
+    of the connection, and get back {"album": directory, "output": text} for
+    each one in order (or {"error": message}). The albums are checked with the
+    options the server was started with.
+    """
+    with contextlib.suppress(FileNotFoundError):
+        if stat.S_ISSOCK(os.stat(path).st_mode):
+            os.unlink(path)
+
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers=config.album_jobs)
+    func = functools.partial(validate_album, config=config)
+
+    class Handler(socketserver.StreamRequestHandler):
+        def send(self, response):
+            self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+            self.wfile.flush()
+
+        def handle(self):
+            requested = collections.deque()
+
+            def albums():
+                for line in self.rfile:
+                    if line.strip():
+                        requested.append(json.loads(line.decode("utf-8"))["album"])
+                        yield requested[-1]
+
+            try:
+                for output, events in bounded_map(executor, func, albums(), config.album_jobs * 2):
+                    PROFILER.extend(events)
+                    self.send({"album": requested.popleft(), "output": output})
+            except (ValueError, KeyError, TypeError) as e:
+                self.send({"error": "Invalid request ({})".format(e)})
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+            except Exception as e:
+                self.send({"error": "Failed to check '{}' ({})".format(requested and requested[0], e)})
+
+            if config.cache is not None:
+                open_cache(config.cache, config.cache_size).evict()
+
+    server = socketserver.ThreadingUnixStreamServer(path, Handler)
+    server.daemon_threads = True
+    log(config, "Listening on '{}' (press Ctrl+C to stop)".format(path))
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(path)
+        executor.shutdown(wait=True)
+
+
+def connect(path, albums):
+    """Check albums with a server started with --serve and print the results
+
+    returns if all the albums were checked
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(path)
+        except OSError as e:
+            print("Couldn't connect to '{}' ({})".format(path, e))
+            return False
+
+        # Send the albums as they're found while the results are read
+        def send():
+            try:
+                for album in albums:
+                    sock.sendall(json.dumps({"album": os.path.abspath(album)}).encode("utf-8") + b"\n")
+                sock.shutdown(socket.SHUT_WR)
+            except OSError:
+                pass
+        sender = threading.Thread(target=send, daemon=True)
+        sender.start()
+
+        with sock.makefile("rb") as f:
+            for line in f:
+                response = json.loads(line.decode("utf-8"))
+                if "error" in response:
+                    print("ERROR: {}".format(response["error"]))
+                    return False
+                sys.stdout.write(response["output"])
+                sys.stdout.flush()
+        sender.join()
+    return True
+
+
+def main():
+    if sys.version_info < (3, 5):
+        print("check-flac requires Python 3.5+ to run")
+        return 1
+
+    config, albums = parse_args()
+    if config.connect is not None:
+        return 0 if connect(config.connect, albums) else 1
+
+    # Warn for missing executables
+    for k in EXTERNAL_PROGRAMS:
+        if not EXTERNALS[k] and k == "flac" and np is not None:
+            log(config, "WARNING: couldn't find the 'flac' executable - using the slower built-in decoder")
+        elif not EXTERNALS[k]:
+            log(config, "WARNING: couldn't find the '{}' executable - some features will be unavailable".format(k))
+
+    if config.cache is not None:
+        try:
+            cache = open_cache(config.cache, config.cache_size)
+        except (OSError, sqlite3.Error) as e:
+            log(config, "WARNING: couldn't open the cache at '{}' ({}) - results won't be cached".format(config.cache, e))
+            config.cache = None
+        else:
+            if config.rebuild_cache:
+                cache.clear()
+
+    journal = None
+    if config.resume is not None:
+        try:
+            journal = Journal(config.resume)
+        except OSError as e:
+            log(config, "ERROR: couldn't open the journal at '{}' ({})".format(config.resume, e))
+            return 1
+
+    start = time.perf_counter()
+    PROFILER.enabled = config.profile or bool(config.profile_trace)
+
+    try:
+        validate_albums(albums, config, journal)
+        if config.cache is not None:
+            cache.evict()
+
+        if config.watch is not None:
+            log(config, "Watching '{}' for changes (press Ctrl+C to stop)".format(config.watch))
+            sys.stdout.flush()
+            try:
+                for albums in watch_albums(config.watch, config.settle_time):
+                    validate_albums(albums, config, journal, keep_going=True)
+                    if config.cache is not None:
+                        cache.evict()
+            except KeyboardInterrupt:
+                pass
+    finally:
+        if journal is not None:
+            journal.close()
+
+    if config.serve is not None:
+        serve(config.serve, config)
+
+    if config.profile:
+        with contextlib.redirect_stdout(sys.stdout if config.format == "text" else sys.stderr):
+            PROFILER.print_report(time.perf_counter() - start)
+    if config.profile_trace:
+        PROFILER.write_trace(config.profile_trace)
 
     return 0
 
+
 if __name__ == "__main__":
     sys.exit(main())
@@ -7,16 +7,15 @@ setup(name="checkflac",
       description="Ensure your personal CD rips conform to a certain standard",
       url="https://github.com/pR0Ps/check-flac",
       license="MIT",
+      python_requires=">=3.5",
       classifiers=[
           "Development Status :: 3 - Alpha",
           "Programming Language :: Python :: 3",
-          "Programming Language :: Python :: 3.3",
-          "Programming Language :: Python :: 3.4",
           "Programming Language :: Python :: 3.5",
           "Programming Language :: Python :: 3.6",
           "Programming Language :: Python :: 3.7",
       ],
       py_modules=["checkflac"],
-      install_requires=["pytaglib >= 1.4.0"],
+      extras_require={"fast": ["numpy"]},
       entry_points={'console_scripts': ["check-flac=checkflac:main"]}
 )
@@ -0,0 +1,104 @@
+import os
+
+import pytest
+
+import checkflac
+from benchmarks import flacgen
+
+
+@pytest.mark.parametrize("checklevel", ("album", "disc", "track"))
+def test_unreadable_tracks(tmp_path, checklevel):
+    directory = flacgen.write_album(str(tmp_path), 0, tracks=2, duration=0.1)
+    os.symlink(str(tmp_path / "missing"), os.path.join(directory, "03 - Track 3.flac"))
+    with open(os.path.join(directory, "04 - Track 4.flac"), "wb") as f:
+        f.write(b"not a FLAC file")
+
+    report = checkflac.check_album(directory, checklevel=checklevel, no_flactest=True, no_cache=True)
+    invalid = sorted(os.path.basename(x.path) for x in report.findings if x.check == "flac_invalid")
+    assert invalid == ["03 - Track 3.flac", "04 - Track 4.flac"]
+    # The tags of the other tracks are still checked like there were only 2 tracks
+    assert not [x for x in report.findings if x.check.startswith("name_") or x.tag == "ALBUMARTIST"]
+
+
+@pytest.mark.parametrize("album_jobs", (1, 2))
+def test_validate_albums_keep_going(tmp_path, capsys, album_jobs):
+    directory = flacgen.write_album(str(tmp_path), 0, tracks=1, duration=0.1)
+    config, _ = checkflac.parse_args([directory, "--no-cache", "--no-flactest", "--album-jobs", str(album_jobs)])
+    missing = str(tmp_path / "missing")
+
+    checkflac.validate_albums([missing, directory], config, keep_going=True)
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[0].startswith("ERROR: couldn't check '{}'".format(missing))
+    assert lines[1] == "Validating <album '{}'>".format(os.path.basename(directory))
+
+
+def test_spellings_only_with_library(tmp_path, monkeypatch):
+    monkeypatch.setattr(checkflac, "CACHE_FILE", str(tmp_path / "cache" / "cache.sqlite"))
+    library = tmp_path / "library"
+    first = flacgen.write_album(str(library), 0, tracks=1, duration=0.1)
+    second = flacgen.write_album(str(library), 1, tracks=1, duration=0.1)
+    for name in os.listdir(second):
+        if name.endswith(".flac"):
+            checkflac.rewrite_tags(os.path.join(second, name), {("set", "LABEL", "LABEL")})
+
+    for directory in (first, second):
+        report = checkflac.check_album(directory, no_flactest=True)
+        assert not [x for x in report.findings if x.check == "spelling"]
+
+    for directory in (first, second):
+        report = checkflac.check_album(directory, no_flactest=True, library=str(library))
+    assert [x.message for x in report.findings if x.check == "spelling"] == [
+        "LABEL 'LABEL' is spelled 'Label' in '{}'".format(first)]
+
+
+def test_resume(tmp_path, capsys, monkeypatch):
+    albums = [flacgen.write_album(str(tmp_path / "library"), i, tracks=1, duration=0.1) for i in range(2)]
+    path = str(tmp_path / "journal")
+    config, _ = checkflac.parse_args(albums + ["--no-cache", "--no-flactest", "--resume", path])
+    checked = []
+    validate_album = checkflac.validate_album
+    monkeypatch.setattr(checkflac, "validate_album", lambda d, c: checked.append(d) or validate_album(d, c))
+
+    def run():
+        del checked[:]
+        journal = checkflac.Journal(path)
+        checkflac.validate_albums(albums, config, journal)
+        journal.close()
+        return capsys.readouterr().out
+
+    output = run()
+    assert checked == albums
+    # Completed albums are replayed without checking them again, even after an interrupted write
+    with open(path, "ab") as f:
+        f.write(b'{"album": ')
+    assert run() == output
+    assert checked == []
+
+    os.utime(next(os.scandir(albums[1])).path)
+    assert run() == output
+    assert checked == albums[1:]
+
+    config.checklevel = checkflac.Level.album
+    run()
+    assert checked == albums
+
+
+def test_check_albums(tmp_path):
+    directories = [flacgen.write_album(str(tmp_path), i, tracks=1, duration=0.1) for i in range(3)]
+    reports = checkflac.check_albums(directories, no_flactest=True, no_cache=True, album_jobs=2)
+    assert [x.album for x in reports] == directories
+
+
+@pytest.mark.parametrize("options", (
+    {"bogus": True},
+    {"checklevel": "everything"},
+    {"jobs": "many"},
+    {"album_jobs": 0},
+    {"dry_run": True},
+), ids=str)
+def test_check_albums_invalid_options(tmp_path, options):
+    with pytest.raises(ValueError):
+        checkflac.check_album(str(tmp_path), **options)
+    # Before any of the albums are checked
+    with pytest.raises(ValueError):
+        checkflac.check_albums([str(tmp_path)], **options)
@@ -0,0 +1,188 @@
+import itertools
+import math
+import struct
+import zlib
+
+import pytest
+
+import checkflac
+
+
+np = checkflac.np
+pytestmark = pytest.mark.skipif(np is None, reason="requires numpy")
+
+
+def consume(consumer_class, samples, sample_rate=44100, channels=2, bps=16, chunk=1000):
+    """Pass interleaved samples to a PCMConsumer in uneven chunks"""
+    streaminfo = checkflac.StreamInfo(*[0] * len(checkflac.StreamInfo._fields))._replace(
+        sample_rate=sample_rate, channels=channels, bits_per_sample=bps, total_samples=len(samples) // channels)
+    consumer = consumer_class(streaminfo)
+    data = struct.pack("<{}h".format(len(samples)), *samples)
+    start = 0
+    for frames in itertools.cycle((chunk, 7, 2 * chunk + 3)):
+        if start >= len(data):
+            break
+        consumer.update(data[start:start + frames * channels * 2])
+        start += frames * channels * 2
+    return consumer.result()
+
+
+def replaygain_reference(samples, sample_rate, channels):
+    """ReplayGain 1.0 sample by sample, like gain_analysis.c"""
+    filtered = []
+    for c in range(channels):
+        y = [float(x) for x in samples[c::channels]]
+        for b, a in checkflac.REPLAYGAIN_FILTERS[sample_rate]:
+            x, y = y, []
+            for n in range(len(x)):
+                value = sum(b[k] * x[n - k] for k in range(min(n + 1, len(b))))
+                value -= sum(a[k] * y[n - k] for k in range(1, min(n + 1, len(a))))
+                y.append(value)
+        filtered.append(y)
+
+    window = math.ceil(sample_rate * 0.05)
+    histogram = [0] * (100 * 120)
+    for start in range(0, len(filtered[0]) - window + 1, window):
+        energy = sum(y[n] ** 2 for y in filtered for n in range(start, start + window)) / window / channels
+        histogram[min(max(int(100 * 10 * math.log10(energy + 1e-37)), 0), len(histogram) - 1)] += 1
+
+    upper = math.ceil(sum(histogram) * 0.05)
+    total = 0
+    for i in range(len(histogram) - 1, -1, -1):
+        total += histogram[i]
+        if total >= upper:
+            return 64.82 - i / 100
+
+
+def tone(seconds, sample_rate, channels, seed=0):
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(seconds * sample_rate)) / sample_rate
+    # A louder second half so the percentile matters
+    envelope = np.where(t < seconds / 2, 0.1, 0.5)
+    x = [envelope * (np.sin(2 * np.pi * f * t) * 16000 + rng.normal(0, 2000, len(t))) for f in (440, 3000)[:channels]]
+    return [int(v) for v in np.clip(np.round(x), -32768, 32767).T.ravel()]
+
+
+@pytest.mark.parametrize("sample_rate, channels", ((44100, 2), (48000, 2), (44100, 1)))
+def test_replaygain_reference(sample_rate, channels):
+    samples = tone(0.6, sample_rate, channels)
+    result = consume(checkflac.ReplayGainConsumer, samples, sample_rate, channels, chunk=5000)
+    assert result["gain"] == pytest.approx(replaygain_reference(samples, sample_rate, channels), abs=0.011)
+
+    histogram = checkflac.decode_histogram(result["histogram"])
+    assert histogram.sum() == int(0.6 * sample_rate) // math.ceil(sample_rate * 0.05)
+    assert checkflac.replaygain(histogram) == result["gain"]
+
+
+def test_replaygain_sine():
+    # The level of a steady sine only depends on the response of the filters
+    frequency, amplitude = 1000, 10000
+    w = np.exp(-2j * np.pi * frequency / 44100)
+    response = 1.0
+    for b, a in checkflac.REPLAYGAIN_FILTERS[44100]:
+        response *= abs(np.polyval(b[::-1], w) / np.polyval(a[::-1], w))
+    expected = 64.82 - 10 * math.log10((amplitude * response) ** 2 / 2)
+
+    t = np.arange(44100 * 2)
+    x = np.round(np.sin(2 * np.pi * frequency * t / 44100) * amplitude).astype(int)
+    result = consume(checkflac.ReplayGainConsumer, [int(v) for v in np.repeat(x, 2)])
+    assert result["gain"] == pytest.approx(expected, abs=0.02)
+
+    assert consume(checkflac.ReplayGainConsumer, [0] * 44100 * 2)["gain"] == pytest.approx(64.82)
+    assert consume(checkflac.ReplayGainConsumer, [0] * 1000)["gain"] is None
+
+
+def accuraterip_reference(samples, first, last):
+    """AccurateRip v1 and v2 one sample at a time, like the reference code"""
+    words = [(l & 0xFFFF) | (r & 0xFFFF) << 16 for l, r in zip(samples[::2], samples[1::2])]
+    v1 = v2 = 0
+    for i, word in enumerate(words, 1):
+        if (first and i < 5 * 588) or (last and i > len(words) - 5 * 588):
+            continue
+        product = i * word
+        v1 += product
+        v2 += (product & 0xFFFFFFFF) + (product >> 32)
+    return v1 & 0xFFFFFFFF, v2 & 0xFFFFFFFF
+
+
+# CD tracks are at least 4 seconds so the samples skipped at the start and end don't overlap
+@pytest.mark.parametrize("frames", (20000, 2 * 5 * 588 + 1))
+def test_accuraterip_reference(frames):
+    rng = np.random.default_rng(frames)
+    samples = [int(x) for x in rng.integers(-32768, 32768, 2 * frames)]
+    # Starts with chunks shorter than the samples AccurateRip skips
+    result = consume(checkflac.AccurateRipConsumer, samples, chunk=1000)
+    assert result["crc32"] == zlib.crc32(struct.pack("<{}h".format(len(samples)), *samples))
+    for first in (False, True):
+        for last in (False, True):
+            assert checkflac.accuraterip_checksums(result, first, last) == accuraterip_reference(samples, first, last)
+
+
+EAC_LOG = """Exact Audio Copy V1.6 from 23. October 2020
+
+Track  1
+
+     Filename C:\\Music\\01 - One.wav
+
+     Peak level 98.2 %
+     Track quality 100.0 %
+     Test CRC 0A1B2C3D
+     Copy CRC 0A1B2C3D
+     Accurately ripped (confidence 12)  [1234ABCD]  (AR v2)
+     Copy OK
+
+Track  2
+
+     Filename C:\\Music\\02 - Two.wav
+
+     Test CRC 11111111
+     Copy CRC DEADBEEF
+     Cannot be verified as accurate (confidence 3)  [89ABCDEF], AccurateRip returned [00000001]  (AR v1)
+     Copy finished
+
+Track  3
+
+     Copy CRC 33333333
+     Track not present in AccurateRip database
+     Copy OK
+
+Track  1  accurately ripped (confidence 12)  [1234ABCD]  (AR v2)
+Track  3  accurately ripped (confidence 2)  [0000FFFF]
+"""
+
+XLD_LOG = """X Lossless Decoder version 20230627 (157.2)
+
+AccurateRip Summary (DiscID: 000f1e2d-00a1b2c3-9e0c5a0b)
+    Track 01 : OK (A1:confidence 4, A2:confidence 3)
+    ->All tracks accurately ripped.
+
+Track 01
+    Filename : /Music/01 - One.flac
+    Pre-gap length : 00:02:00
+
+    CRC32 hash (test run)  : 11111111
+    CRC32 hash             : 0A1B2C3D
+    CRC32 hash (skip zero) : 22222222
+    AccurateRip v1 signature : 1234ABCD
+        ->Accurately ripped (v1+v2, confidence 4+3/7)
+    AccurateRip v2 signature : 89ABCDEF
+    Statistics
+        Read error                           : 0
+"""
+
+
+def test_parse_rip_log(tmp_path):
+    path = tmp_path / "eac.log"
+    # EAC writes UTF-16 with a BOM
+    path.write_bytes(EAC_LOG.replace("\n", "\r\n").encode("utf-16"))
+    assert checkflac.parse_rip_log(str(path)) == {
+        1: {"crc32": 0x0A1B2C3D, "accuraterip": {2: 0x1234ABCD}},
+        2: {"crc32": 0xDEADBEEF, "accuraterip": {1: 0x89ABCDEF}},
+        3: {"crc32": 0x33333333, "accuraterip": {1: 0x0000FFFF}},
+    }
+
+    path = tmp_path / "xld.log"
+    path.write_text(XLD_LOG)
+    assert checkflac.parse_rip_log(str(path)) == {
+        1: {"crc32": 0x0A1B2C3D, "accuraterip": {1: 0x1234ABCD, 2: 0x89ABCDEF}},
+    }
@@ -0,0 +1,69 @@
+import os
+
+import pytest
+
+import checkflac
+from benchmarks import flacgen
+
+
+MD5 = bytes(range(16))
+
+
+def make_album(tmp_path, name):
+    directory = tmp_path / name
+    directory.mkdir()
+    (directory / "1.flac").write_bytes(b"")
+    return str(directory), str(directory / "1.flac")
+
+
+def test_clear_keeps_indexes(tmp_path):
+    cache = checkflac.VerificationCache(str(tmp_path / "cache.sqlite"), 1 << 20)
+    album, path = make_album(tmp_path, "a")
+    other_album, other_path = make_album(tmp_path, "b")
+    cache.put(path, (1, 2, 3, MD5), True)
+    cache.update_audio(album, [(path, MD5, 100)])
+    cache.update_names(album, [("LABEL", "Label")])
+
+    cache.clear()
+    assert cache.get(path, (1, 2, 3, MD5)) is None
+    assert cache.update_audio(other_album, [(other_path, MD5, 100)]) == {other_path: [(album, path)]}
+    assert cache.update_names(other_album, [("LABEL", "label")]) == {("LABEL", "label"): [(album, "Label")]}
+
+
+def test_get_changed_file(tmp_path):
+    cache = checkflac.VerificationCache(str(tmp_path / "cache.sqlite"), 1 << 20)
+    album, path = make_album(tmp_path, "a")
+    key = cache.file_key(path, MD5)
+    assert cache.get(path, key) is None
+    cache.put(path, key, True, {"md5": "x"})
+    assert cache.get(path, cache.file_key(path, MD5)) == (True, {"md5": "x"})
+
+    os.utime(path, ns=(0, key[1] + 1))
+    assert cache.get(path, cache.file_key(path, MD5)) is None
+    os.utime(path, ns=(0, key[1]))
+    with open(path, "ab") as f:
+        f.write(b"x")
+    os.utime(path, ns=(0, key[1]))
+    assert cache.get(path, cache.file_key(path, MD5)) is None
+    assert cache.get(path, cache.file_key(path, bytes(16))) is None
+
+
+@pytest.mark.skipif(checkflac.np is None, reason="requires numpy")
+def test_cached_results(tmp_path, monkeypatch):
+    monkeypatch.setattr(checkflac, "CACHE_FILE", str(tmp_path / "cache" / "cache.sqlite"))
+    monkeypatch.setitem(checkflac.EXTERNALS, "flac", False)
+    tested = []
+    analyse_audio = checkflac.analyse_audio
+    monkeypatch.setattr(checkflac, "analyse_audio", lambda path, *args: tested.append(path) or analyse_audio(path, *args))
+    directory = flacgen.write_album(str(tmp_path), 0, tracks=2, duration=0.1)
+    paths = sorted(os.path.join(directory, x) for x in os.listdir(directory) if x.endswith(".flac"))
+
+    checkflac.check_album(directory)
+    assert sorted(tested) == paths
+    del tested[:]
+    checkflac.check_album(directory)
+    assert tested == []
+
+    os.utime(paths[0])
+    checkflac.check_album(directory)
+    assert tested == paths[:1]
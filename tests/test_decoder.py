@@ -0,0 +1,226 @@
+import hashlib
+import struct
+
+import pytest
+
+import checkflac
+from benchmarks import flacgen
+
+
+np = checkflac.np
+SAMPLE_SIZE_CODES = {8: 1, 12: 2, 16: 4, 20: 5, 24: 6, 32: 7}
+SIDE_CHANNEL = {8: 1, 9: 0, 10: 1}  # The channel that has an extra bit for each assignment
+
+
+class BitWriter(object):
+
+    def __init__(self):
+        self.bits = []
+
+    def write(self, value, bits):
+        if bits:
+            self.bits.append(format(value & ((1 << bits) - 1), "0{}b".format(bits)))
+
+    def unary(self, value):
+        self.bits.append("0" * value + "1")
+
+    def tobytes(self):
+        bits = "".join(self.bits)
+        bits += "0" * (-len(bits) % 8)
+        return int(bits, 2).to_bytes(len(bits) // 8, "big") if bits else b""
+
+
+def write_residual(w, residual, order, method, escape):
+    blocksize = len(residual) + order
+    partitions = max(p for p in range(4) if blocksize % (1 << p) == 0 and blocksize >> p >= order)
+    w.write(method, 2)
+    w.write(partitions, 4)
+    param_bits, max_k = (5, 30) if method else (4, 14)
+    pos = 0
+    for i in range(1 << partitions):
+        part = residual[pos:pos + (blocksize >> partitions) - (order if i == 0 else 0)]
+        pos += len(part)
+        if escape and i == 0:
+            bits = max((abs(x).bit_length() + 1 for x in part if x), default=0)
+            w.write((1 << param_bits) - 1, param_bits)
+            w.write(bits, 5)
+            for x in part:
+                w.write(x, bits)
+            continue
+        zigzag = [2 * x if x >= 0 else -2 * x - 1 for x in part]
+        k = min(range(max_k + 1), key=lambda k: sum(x >> k for x in zigzag) + len(zigzag) * k)
+        w.write(k, param_bits)
+        for x in zigzag:
+            w.unary(x >> k)
+            w.write(x, k)
+
+
+def lpc_coefficients(x, order):
+    """Quantised coefficients that predict x reasonably well (precision 15)"""
+    a = np.array(x, dtype=np.float64)
+    rows = np.array([a[t - order:t][::-1] for t in range(order, len(a))])
+    coefs = np.linalg.lstsq(rows, a[order:], rcond=None)[0]
+    top = max(abs(coefs).max(), 1e-3)
+    shift = int(min(15, max(0, 13 - np.ceil(np.log2(top)))))
+    return [int(np.clip(round(c * (1 << shift)), -(1 << 14), (1 << 14) - 1)) for c in coefs], shift
+
+
+def write_subframe(w, x, bps, kind, order, method, escape):
+    wasted = 0
+    if any(x):
+        while all(v % (1 << (wasted + 1)) == 0 for v in x):
+            wasted += 1
+    x = [v >> wasted for v in x]
+    bps -= wasted
+
+    types = {"constant": 0, "verbatim": 1, "fixed": 8 + order, "lpc": 31 + order}
+    w.write(types[kind] << 1 | bool(wasted), 8)
+    if wasted:
+        w.unary(wasted - 1)
+
+    if kind == "constant":
+        w.write(x[0], bps)
+    elif kind == "verbatim":
+        for v in x:
+            w.write(v, bps)
+    elif kind == "fixed":
+        for v in x[:order]:
+            w.write(v, bps)
+        write_residual(w, [int(r) for r in np.diff(np.array(x, dtype=object), n=order)], order, method, escape)
+    else:
+        coefs, shift = lpc_coefficients(x, order)
+        for v in x[:order]:
+            w.write(v, bps)
+        w.write(14, 4)
+        w.write(shift, 5)
+        for c in coefs:
+            w.write(c, 15)
+        residual = [x[t] - (sum(c * x[t - 1 - j] for j, c in enumerate(coefs)) >> shift)
+                    for t in range(order, len(x))]
+        write_residual(w, residual, order, method, escape)
+
+
+def signal(total, channels, bps, kind, wasted, seed):
+    rng = np.random.default_rng(seed)
+    peak = (1 << (bps - 1)) - 1
+    if kind == "constant":
+        return np.tile(rng.integers(-peak, peak, (channels, 1)), total)
+    t = np.arange(total)
+    x = [np.sin(t * rng.uniform(0.01, 0.1) + rng.uniform(0, 6)) * peak * 0.4 +
+         rng.normal(0, 1 << max(bps - 10, 0), total) for _ in range(channels)]
+    x = np.clip(np.round(x), -peak - 1, peak).astype(np.int64)
+    return x >> wasted << wasted
+
+
+def write_flac(path, bps=16, channels=2, assignment=None, kind="lpc", order=8, method=0,
+               escape=False, wasted=0, total=3000, blocksize=1152, corruption=None, seed=0):
+    """Encode a test signal with the given kind of subframes
+
+    corruption is "bitflip" or "truncate" (caught by the frame CRCs) or "sample"
+    (a wrong sample with correct CRCs, only caught by the MD5)
+    """
+    x = signal(total, channels, bps, kind, wasted, seed)
+    width = (bps + 7) // 8
+    md5 = hashlib.md5(np.ascontiguousarray(x.T, dtype="<i4").view(np.uint8).reshape(-1, 4)[:, :width].tobytes())
+    if corruption == "sample":
+        x[0, 100] ^= 1 << wasted
+
+    audio, offsets = bytearray(), []
+    for number, start in enumerate(range(0, total, blocksize)):
+        chunk = [list(map(int, c[start:start + blocksize])) for c in x]
+        size = len(chunk[0])
+        bits = [bps] * channels
+        if assignment is not None:
+            left, right = chunk
+            side = [a - b for a, b in zip(left, right)]
+            chunk = {8: [left, side], 9: [side, right], 10: [[(a + b) >> 1 for a, b in zip(left, right)], side]}[assignment]
+            bits[SIDE_CHANNEL[assignment]] += 1
+
+        header = bytes([0xFF, 0xF8, 0x70 | flacgen.SAMPLE_RATE_CODES[44100],
+                        ((channels - 1 if assignment is None else assignment) << 4) | (SAMPLE_SIZE_CODES[bps] << 1)])
+        header += flacgen._utf8_number(number) + (size - 1).to_bytes(2, "big")
+        w = BitWriter()
+        for c in range(channels):
+            write_subframe(w, chunk[c], bits[c], kind, order, method, escape)
+        offsets.append(len(audio))
+        audio += header + bytes([flacgen.crc8(header)]) + w.tobytes() + b"\x00\x00"
+
+    lengths = [b - a - 2 for a, b in zip(offsets, offsets[1:] + [len(audio)])]
+    for offset, length, crc in zip(offsets, lengths, flacgen.crc16_frames(audio, offsets, lengths)):
+        audio[offset + length:offset + length + 2] = crc.to_bytes(2, "big")
+    if corruption == "bitflip":
+        audio[len(audio) // 2] ^= 0x10
+    elif corruption == "truncate":
+        del audio[len(audio) * 2 // 3:]
+
+    streaminfo = struct.pack(">HH", blocksize, blocksize) + bytes(6)
+    streaminfo += ((44100 << 44) | ((channels - 1) << 41) | ((bps - 1) << 36) | total).to_bytes(8, "big")
+    streaminfo += md5.digest()
+    with open(path, "wb") as f:
+        f.write(b"fLaC")
+        f.write(flacgen._metadata_block(checkflac.MetadataBlock.STREAMINFO, streaminfo, False))
+        f.write(flacgen._metadata_block(checkflac.MetadataBlock.VORBIS_COMMENT, flacgen.vorbis_comment({}), True))
+        f.write(audio)
+    return path
+
+
+def verify(path, monkeypatch):
+    monkeypatch.setitem(checkflac.EXTERNALS, "flac", False)
+    return checkflac.analyse_audio(path, checkflac.FlacMetadata(path), (checkflac.MD5Consumer,))[0]
+
+
+def test_crc_known_answers():
+    assert checkflac.crc8(b"123456789") == 0xF4
+    assert checkflac.crc16(b"123456789") == 0xFEE8
+    assert flacgen.crc8(b"123456789") == 0xF4
+    assert flacgen.crc16_frames(b"123456789", [0], [9]) == [0xFEE8]
+
+
+@pytest.mark.skipif(np is None, reason="requires numpy")
+@pytest.mark.parametrize("options", [
+    {"kind": "constant"},
+    {"kind": "verbatim"},
+    {"kind": "fixed", "order": 0},
+    {"kind": "fixed", "order": 1},
+    {"kind": "fixed", "order": 2},
+    {"kind": "fixed", "order": 3},
+    {"kind": "fixed", "order": 4},
+    {"kind": "lpc", "order": 1},
+    {"kind": "lpc", "order": 32},
+    {"kind": "lpc", "method": 1},
+    {"kind": "lpc", "escape": True},
+    {"kind": "fixed", "order": 2, "escape": True, "method": 1},
+    {"kind": "lpc", "wasted": 3},
+    {"assignment": 8},
+    {"assignment": 9},
+    {"assignment": 10},
+    {"assignment": 10, "wasted": 2},
+    {"channels": 1},
+    {"channels": 6, "kind": "fixed", "order": 2},
+    {"bps": 8},
+    {"bps": 12},
+    {"bps": 20, "assignment": 10},
+    {"bps": 24},
+    {"bps": 24, "kind": "fixed", "order": 1, "assignment": 9},
+    {"bps": 32, "kind": "verbatim"},
+    {"bps": 32, "kind": "fixed", "order": 1, "method": 1},
+    {"blocksize": 4096, "total": 10000, "kind": "fixed", "order": 2},
+], ids=str)
+def test_decode(tmp_path, monkeypatch, options):
+    assert verify(write_flac(str(tmp_path / "a.flac"), **options), monkeypatch)
+
+
+@pytest.mark.skipif(np is None, reason="requires numpy")
+@pytest.mark.parametrize("corruption", ("bitflip", "truncate", "sample"))
+def test_decode_corrupt(tmp_path, monkeypatch, corruption):
+    assert verify(write_flac(str(tmp_path / "a.flac"), corruption=corruption), monkeypatch) is False
+
+
+@pytest.mark.skipif(np is None, reason="requires numpy")
+@pytest.mark.parametrize("encoding", flacgen.ENCODINGS)
+def test_decode_flacgen(tmp_path, monkeypatch, encoding):
+    path = str(tmp_path / "a.flac")
+    flacgen.write_flac(path, 0.3, {}, bps=24, encoding=encoding)
+    assert verify(path, monkeypatch)
+    flacgen.write_flac(path, 0.3, {}, bps=24, encoding=encoding, corruption="bitflip")
+    assert verify(path, monkeypatch) is False
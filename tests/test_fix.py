@@ -0,0 +1,116 @@
+import os
+
+import checkflac
+from benchmarks import flacgen
+
+
+TAGS = {"ARTIST": ["Artist"], "TITLE": ["Title"], "DATE": ["2000"]}
+
+
+def write_flac(path, tags=TAGS, padding=4096, prefix=b""):
+    flacgen.write_flac(str(path), 0.1, tags, padding=padding)
+    if prefix:
+        with open(str(path), "rb") as f:
+            data = f.read()
+        with open(str(path), "wb") as f:
+            f.write(prefix + data)
+    return str(path)
+
+
+def id3_tag(payload=b"\x00" * 20):
+    size = len(payload)
+    return b"ID3\x04\x00\x00" + bytes((size >> (7 * i)) & 0x7F for i in (3, 2, 1, 0)) + payload
+
+
+def read_comments(path):
+    return checkflac.rewrite_tags(path, [], dry_run=True)[0]
+
+
+def read_audio(path):
+    metadata = checkflac.FlacMetadata(path)
+    with open(path, "rb") as f:
+        f.seek(metadata.audio_offset)
+        return f.read()
+
+
+def test_fix_comments():
+    comments = ["YEAR=2000", "title= Title ", "COMMENT= ", "COMMENT=", "ARTISTSORT=x"]
+    fixes = {("rename", "YEAR", "DATE"), ("strip", "TITLE"), ("strip", "COMMENT"),
+             ("delete", "ARTISTSORT"), ("set", "COMPILATION", "1")}
+    assert checkflac.fix_comments(comments, fixes) == [
+        "DATE=2000", "title=Title", "COMMENT= ", "COMMENT=", "COMPILATION=1"]
+
+    fixes = {("delete_blank", "COMMENT"), ("strip", "COMMENT")}
+    assert checkflac.fix_comments(["COMMENT= ", "COMMENT= x"], fixes) == ["COMMENT=x"]
+
+
+def test_fix_comments_rename_existing():
+    fixes = {("rename", "YEAR", "DATE")}
+    assert checkflac.fix_comments(["YEAR=2000", "DATE=2001"], fixes) == ["DATE=2001"]
+    assert checkflac.fix_comments(["YEAR=2000"], fixes) == ["DATE=2000"]
+
+
+def test_rewrite_tags_in_place(tmp_path):
+    path = write_flac(tmp_path / "a.flac")
+    size = os.path.getsize(path)
+    audio = read_audio(path)
+    inode = os.stat(path).st_ino
+
+    old, new = checkflac.rewrite_tags(path, {("set", "COMMENT", "x" * 100)})
+    assert new == old + ["COMMENT=" + "x" * 100]
+    assert read_comments(path) == new
+    assert os.path.getsize(path) == size
+    assert os.stat(path).st_ino == inode
+    assert read_audio(path) == audio
+    # Each comment is stored after its 4 byte length
+    assert checkflac.FlacMetadata(path).padding == 4096 - 4 - len(new[-1])
+
+
+def test_rewrite_tags_rewrite(tmp_path):
+    path = write_flac(tmp_path / "a.flac", padding=0)
+    audio = read_audio(path)
+
+    old, new = checkflac.rewrite_tags(path, {("set", "COMMENT", "x")})
+    assert read_comments(path) == new == old + ["COMMENT=x"]
+    assert read_audio(path) == audio
+    assert checkflac.FlacMetadata(path).padding == checkflac.FIX_PADDING
+    assert os.listdir(str(tmp_path)) == ["a.flac"]
+
+
+def test_rewrite_tags_dry_run(tmp_path):
+    path = write_flac(tmp_path / "a.flac")
+    with open(path, "rb") as f:
+        data = f.read()
+
+    old, new = checkflac.rewrite_tags(path, {("delete", "DATE")}, dry_run=True)
+    assert new == [x for x in old if not x.startswith("DATE=")]
+    with open(path, "rb") as f:
+        assert f.read() == data
+
+
+def test_rewrite_tags_id3_prefix(tmp_path):
+    prefix = id3_tag()
+    for padding in (4096, 0):
+        path = write_flac(tmp_path / "{}.flac".format(padding), padding=padding, prefix=prefix)
+        audio = read_audio(path)
+
+        old, new = checkflac.rewrite_tags(path, {("set", "COMMENT", "x")})
+        assert read_comments(path) == new == old + ["COMMENT=x"]
+        assert read_audio(path) == audio
+        with open(path, "rb") as f:
+            assert f.read(len(prefix) + 4) == prefix + b"fLaC"
+
+
+def test_fix_album_mixed_tags(tmp_path):
+    directory = flacgen.write_album(str(tmp_path), 0, tracks=3, duration=0.1)
+    paths = sorted(os.path.join(directory, x) for x in os.listdir(directory) if x.endswith(".flac"))
+    # Only the first track already has a DATE
+    checkflac.rewrite_tags(paths[0], {("set", "YEAR", "2000")})
+    for path in paths[1:]:
+        checkflac.rewrite_tags(path, {("rename", "DATE", "YEAR")})
+
+    checkflac.check_album(directory, fix=True, no_flactest=True, no_cache=True)
+    for path in paths:
+        names = [x.partition("=")[0] for x in read_comments(path)]
+        assert names.count("DATE") == 1
+        assert "YEAR" not in names
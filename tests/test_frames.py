@@ -0,0 +1,45 @@
+import random
+
+import pytest
+
+import checkflac
+from benchmarks import flacgen
+
+
+def test_crc16_regions(monkeypatch):
+    rng = random.Random(0)
+    data = bytes(rng.getrandbits(8) for _ in range(20000))
+    starts = [0, 1, 5, 100, 7000, 19999, 3]
+    lengths = [0, 1, 9, 4096, 12345, 1, 17]
+    expected = [checkflac.crc16(data[s:s + l]) for s, l in zip(starts, lengths)]
+    assert checkflac.crc16_regions(data, starts, lengths) == expected
+    assert checkflac.crc16_regions(b"xx123456789", [2], [9]) == [0xFEE8]
+
+    monkeypatch.setattr(checkflac, "np", None)
+    assert checkflac.crc16_regions(data, starts, lengths) == expected
+
+
+@pytest.mark.parametrize("encoding", [x for x in flacgen.ENCODINGS if checkflac.np is not None or x == "verbatim"])
+def test_find_frames(tmp_path, encoding):
+    path = str(tmp_path / "a.flac")
+    flacgen.write_flac(path, 1, {}, encoding=encoding)
+    metadata = checkflac.FlacMetadata(path)
+    with open(path, "rb") as f:
+        data = f.read()
+
+    frames, samples, errors = checkflac.find_frames(data, metadata)
+    assert errors == []
+    assert samples == metadata.streaminfo.total_samples == 44100
+    assert [f[3] for f in frames] == [flacgen.BLOCKSIZE] * 10 + [44100 - 10 * flacgen.BLOCKSIZE]
+    assert frames[0][0] == metadata.audio_offset
+    assert frames[-1][0] + frames[-1][1] == len(data)
+    assert all(a[0] + a[1] == b[0] for a, b in zip(frames, frames[1:]))
+    assert checkflac.bad_frames(data, frames) == []
+    assert checkflac.verify_frames(path, metadata) == []
+
+
+@pytest.mark.parametrize("corruption", ("bitflip", "truncate"))
+def test_verify_frames_corrupt(tmp_path, corruption):
+    path = str(tmp_path / "a.flac")
+    flacgen.write_flac(path, 1, {}, corruption=corruption)
+    assert checkflac.verify_frames(path, checkflac.FlacMetadata(path))